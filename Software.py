@@ -1,6 +1,6 @@
 # Copyright (c) 2018 by Software.com
 
-from threading import Thread, Timer, Event
+from threading import Thread, Event
 from package_control import events
 from queue import Queue
 import webbrowser
@@ -10,25 +10,60 @@ import json
 import os
 import sublime_plugin, sublime
 from .lib.SoftwareHttp import *
+from .lib.SoftwareNetwork import *
 from .lib.SoftwareUtil import *
 from .lib.SoftwareMusic import *
 from .lib.SoftwareRepo import *
 from .lib.SoftwareOffline import *
 from .lib.SoftwareSettings import *
+from .lib.SoftwareEvents import *
+from .lib.SoftwareScheduler import *
+from .lib.SoftwareLineCounts import *
 
 DEFAULT_DURATION = 60
 
 PROJECT_DIR = None
 
+# window commands that change the folders or project of a window
+PROJECT_WINDOW_COMMANDS = set([
+    'prompt_add_folder',
+    'remove_folder',
+    'close_folder_list',
+    'close_project',
+    'close_workspace',
+    'open_project',
+    'prompt_open_project_or_workspace',
+    'prompt_select_workspace',
+    'switch_project',
+    'save_project_and_workspace_as',
+])
+
 check_online_interval_sec = 60 * 10
 retry_counter = 0
+user_status_job = None
 
-# payload trigger to store it for later.
-def post_json(json_data):
-    # save the data to the offline data file
-    storePayload(json_data)
+# payload trigger to store the flushed interval for later.
+def post_json(active_datas):
+    PluginData.endUnendedFileEndTimes(active_datas)
+
+    payloads = []
+    for dir in active_datas:
+        keystrokeCountObj = active_datas[dir]
+
+        # get the lines so we can add that back
+        for fileName in keystrokeCountObj.source:
+            fileInfo = keystrokeCountObj.source[fileName]
+            # add the lines for this file so we can re-use again
+            PluginData.line_counts.put(fileName, fileInfo.lines)
+
+        if keystrokeCountObj.hasData():
+            payloads.append(keystrokeCountObj.as_dict())
 
-    PluginData.reset_source_data()
+    PluginData.line_counts.save()
+
+    # save the data to the offline data file
+    if payloads:
+        storePayloads(payloads)
 
 #
 # Background thread used to send data every minute.
@@ -49,6 +84,33 @@ class BackgroundWorker():
             self.target_func(self.queue.get())
             self.queue.task_done()
 
+#
+# per file metrics within a kpm payload
+#
+class FileInfo():
+    __slots__ = ('paste', 'open', 'close', 'length', 'delete', 'netkeys', 'add', 'lines', 'linesAdded', 'linesRemoved', 'syntax', 'start', 'local_start', 'end', 'local_end')
+
+    def __init__(self, start, local_start):
+        self.paste = 0
+        self.open = 0
+        self.close = 0
+        self.length = 0
+        self.delete = 0
+        self.netkeys = 0
+        self.add = 0
+        self.lines = -1
+        self.linesAdded = 0
+        self.linesRemoved = 0
+        self.syntax = ""
+        self.start = start
+        self.local_start = local_start
+        self.end = 0
+        self.local_end = 0
+
+    # the json shape the api expects for a file
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
 #
 # kpm payload data structure
 #
@@ -56,7 +118,12 @@ class PluginData():
     __slots__ = ('source', 'keystrokes', 'start', 'local_start', 'project', 'pluginId', 'version', 'os', 'timezone')
     background_worker = BackgroundWorker(1, post_json)
     active_datas = {}
-    line_counts = {}
+    # fileName => (keystrokeCountObj, fileInfo)
+    file_index = {}
+    focused_file = None
+    # window id => {fileName: project}
+    project_cache = {}
+    line_counts = LineCountCache()
     send_timer = None
 
     def __init__(self, project):
@@ -71,21 +138,13 @@ class PluginData():
         self.timezone = getTimezone()
         self.os = getOs()
 
-    def json(self):
-
-        # make sure all file end times are set
-
+    # the payload the api expects, only serialized once it gets stored
+    def as_dict(self):
         dict_data = {key: getattr(self, key, None)
                      for key in self.__slots__}
-
-        return json.dumps(dict_data)
-
-    # send the kpm info
-    def send(self):
-        # check if it has data
-        if PluginData.background_worker and self.hasData():
-            PluginData.endUnendedFileEndTimes()
-            PluginData.background_worker.queue.put(self.json())
+        dict_data['source'] = {fileName: fileInfo.as_dict()
+                               for fileName, fileInfo in self.source.items()}
+        return dict_data
 
     # check if we have data
     def hasData(self):
@@ -93,33 +152,32 @@ class PluginData():
             return True
         for fileName in self.source:
             fileInfo = self.source[fileName]
-            if (fileInfo['close'] > 0 or
-                fileInfo['open'] > 0 or
-                fileInfo['paste'] > 0 or
-                fileInfo['delete'] > 0 or
-                fileInfo['add'] > 0 or
-                fileInfo['netkeys'] > 0):
+            if (fileInfo.close > 0 or
+                fileInfo.open > 0 or
+                fileInfo.paste > 0 or
+                fileInfo.delete > 0 or
+                fileInfo.add > 0 or
+                fileInfo.netkeys > 0):
                 return True
         return False
 
+    # swap in a new set of payloads for every project and hand the
+    # previous ones to the background worker. This runs on the event
+    # aggregator thread so no keystroke is recorded mid-flush.
     @staticmethod
-    def reset_source_data():
+    def flush_all():
+        # a flush before the timer fires starts a new interval, the
+        # timer's own flush has nothing left to cancel
+        if PluginData.send_timer is not None:
+            PluginData.send_timer.cancel()
         PluginData.send_timer = None
 
-        for dir in PluginData.active_datas:
-            keystrokeCountObj = PluginData.active_datas[dir]
-            
-            # get the lines so we can add that back
-            for fileName in keystrokeCountObj.source:
-                fileInfo = keystrokeCountObj.source[fileName]
-                # add the lines for this file so we can re-use again
-                PluginData.line_counts[fileName] = fileInfo.get("lines", 0)
-
-            if keystrokeCountObj is not None:
-                keystrokeCountObj.source = {}
-                keystrokeCountObj.keystrokes = 0
-                keystrokeCountObj.project['identifier'] = None
-                keystrokeCountObj.timezone = getTimezone()
+        active_datas = PluginData.active_datas
+        PluginData.active_datas = {}
+        PluginData.file_index = {}
+
+        if active_datas and PluginData.background_worker:
+            PluginData.background_worker.queue.put(active_datas)
 
     @staticmethod
     def create_empty_payload(fileName, projectName):
@@ -132,16 +190,51 @@ class PluginData():
         return return_data
 
     @staticmethod
-    def get_active_data(view):
+    def get_active_data(fileName, windowId, variables, now):
         return_data = None
-        if view is None or view.window() is None:
+        if windowId is None:
             return return_data
 
-        fileName = view.file_name()
-        if (fileName is None):
-            fileName = "Untitled"
+        project = PluginData.resolve_project(windowId, fileName, variables)
+
+        old_active_data = None
+        if project['directory'] in PluginData.active_datas:
+            old_active_data = PluginData.active_datas[project['directory']]
+        
+        if old_active_data is None:
+            new_active_data = PluginData(dict(project))
+
+            PluginData.active_datas[project['directory']] = new_active_data
+            return_data = new_active_data
+        else:
+            return_data = old_active_data
+
+        fileInfoData = PluginData.get_file_info_and_initialize_if_none(return_data, fileName, now)
+
+        # This activates the 60 second timer. The scheduled
+        # job hands the flush to the event aggregator
+        if (PluginData.send_timer is None):
+            PluginData.send_timer = runLater(DEFAULT_DURATION, PluginData.event_aggregator.call, PluginData.flush_all)
+
+        return return_data
 
-        sublime_variables = view.window().extract_variables()
+    # get the project for the file from the window variables captured
+    # with the event, they're only captured the first time a file is
+    # seen within a window
+    @staticmethod
+    def resolve_project(windowId, fileName, sublime_variables):
+        window_projects = PluginData.project_cache.get(windowId)
+        if window_projects is None:
+            window_projects = {}
+            PluginData.project_cache[windowId] = window_projects
+
+        project = window_projects.get(fileName)
+        if project is not None:
+            return project
+
+        if sublime_variables is None:
+            # the projects were invalidated after the event was captured
+            sublime_variables = PluginData.get_window_variables(windowId)
         project = {}
 
         # set it to none as a default
@@ -167,89 +260,95 @@ class PluginData():
         else:
             project['directory'] = 'Unnamed'
 
-        old_active_data = None
-        if project['directory'] in PluginData.active_datas:
-            old_active_data = PluginData.active_datas[project['directory']]
-        
-        if old_active_data is None:
-            new_active_data = PluginData(project)
+        window_projects[fileName] = project
+        return project
 
-            PluginData.active_datas[project['directory']] = new_active_data
-            return_data = new_active_data
-        else:
-            return_data = old_active_data
-
-        fileInfoData = PluginData.get_file_info_and_initialize_if_none(return_data, fileName)
+    # whether the aggregator still has the project of the file, read
+    # when capturing events
+    @staticmethod
+    def has_project(windowId, fileName):
+        window_projects = PluginData.project_cache.get(windowId)
+        return window_projects is not None and fileName in window_projects
 
-        # This activates the 60 second timer. The callback
-        # in the Timer sends the data
-        if (PluginData.send_timer is None):
-            PluginData.send_timer = Timer(DEFAULT_DURATION, return_data.send)
-            PluginData.send_timer.start()
+    @staticmethod
+    def get_window_variables(windowId):
+        for window in sublime.windows():
+            if window.id() == windowId:
+                return window.extract_variables()
+        return {}
 
-        return return_data
+    # forget the resolved projects of a window (or all windows)
+    @staticmethod
+    def invalidate_projects(windowId=None):
+        if windowId is None:
+            PluginData.project_cache = {}
+        else:
+            PluginData.project_cache.pop(windowId, None)
 
     # ...
     @staticmethod
     def get_existing_file_info(fileName):
-        fileInfoData = None
+        # look up the FileInfo object through the fileName index
+        # instead of scanning every KeystrokesCount object
+        entry = PluginData.file_index.get(fileName)
+        if entry is None:
+            return None
+        return entry[1]
+
+    # end the previously focused file and re-open the newly focused one
+    @staticmethod
+    def focus_file(fileName, now=None):
+        if fileName == PluginData.focused_file:
+            return
 
-        now = round(time.time())
-        local_start = getLocalStart()
-        # Get the FileInfo object within the KeystrokesCount object
-        # based on the specified fileName.
-        for dir in PluginData.active_datas:
-            keystrokeCountObj = PluginData.active_datas[dir]
-            if keystrokeCountObj is not None:
-                hasExistingKeystrokeObj = True
-                # we have a keystroke count object, get the fileInfo
-                if keystrokeCountObj.source is not None and fileName in keystrokeCountObj.source:
-                    # set the fileInfoData we'll return the calling def
-                    fileInfoData = keystrokeCountObj.source[fileName]
-                else:
-                    # end the other files end times
-                    for fileName in keystrokeCountObj.source:
-                        fileInfo = keystrokeCountObj.source[fileName]
-                        fileInfo["end"] = now
-                        fileInfo["local_end"] = local_start
+        previousEntry = PluginData.file_index.get(PluginData.focused_file)
+        if previousEntry is not None:
+            if now is None:
+                now = round(time.time())
+            fileInfo = previousEntry[1]
+            fileInfo.end = now
+            fileInfo.local_end = getLocalStart(now)
 
-        return fileInfoData
+        PluginData.focused_file = fileName
+
+        entry = PluginData.file_index.get(fileName)
+        if entry is not None:
+            # the file is getting modified again
+            fileInfo = entry[1]
+            fileInfo.end = 0
+            fileInfo.local_end = 0
 
     # 
     @staticmethod
-    def endUnendedFileEndTimes():
+    def endUnendedFileEndTimes(active_datas):
         now = round(time.time())
         local_start = getLocalStart()
         
-        for dir in PluginData.active_datas:
-            keystrokeCountObj = PluginData.active_datas[dir]
+        for dir in active_datas:
+            keystrokeCountObj = active_datas[dir]
             if keystrokeCountObj is not None and keystrokeCountObj.source is not None:
                 for fileName in keystrokeCountObj.source:
                     fileInfo = keystrokeCountObj.source[fileName]
-                    if (fileInfo.get("end", 0) == 0):
-                        fileInfo["end"] = now
-                        fileInfo["local_end"] = local_start
-
-    @staticmethod
-    def send_all_datas():
-        for dir in PluginData.active_datas:
-            PluginData.active_datas[dir].send()
+                    if (fileInfo.end == 0):
+                        fileInfo.end = now
+                        fileInfo.local_end = local_start
 
     #.........
     @staticmethod
-    def initialize_file_info(keystrokeCount, fileName):
+    def initialize_file_info(keystrokeCount, fileName, now=None):
         if keystrokeCount is None:
             return
 
         if fileName is None or fileName == '':
             fileName = 'Untitled'
         
-        # create the new FileInfo, which will contain a dictionary
-        # of fileName and it's metrics
+        # get the existing FileInfo, which holds the metrics
+        # of fileName
         fileInfoData = PluginData.get_existing_file_info(fileName)
 
-        now = round(time.time())
-        local_start = getLocalStart()
+        if now is None:
+            now = round(time.time())
+        local_start = getLocalStart(now)
 
         if keystrokeCount.start == 0:
             keystrokeCount.start = now
@@ -261,35 +360,23 @@ class PluginData():
         # "keys" = add + delete
         # "delete" = delete keystrokes
         if fileInfoData is None:
-            fileInfoData = {}
-            fileInfoData['paste'] = 0
-            fileInfoData['open'] = 0
-            fileInfoData['close'] = 0
-            fileInfoData['length'] = 0
-            fileInfoData['delete'] = 0
-            fileInfoData['netkeys'] = 0
-            fileInfoData['add'] = 0
-            fileInfoData['lines'] = -1
-            fileInfoData['linesAdded'] = 0
-            fileInfoData['linesRemoved'] = 0
-            fileInfoData['syntax'] = ""
-            fileInfoData['start'] = now
-            fileInfoData['local_start'] = local_start
-            fileInfoData['end'] = 0
-            fileInfoData['local_end'] = 0
+            fileInfoData = FileInfo(now, local_start)
             keystrokeCount.source[fileName] = fileInfoData
+            PluginData.file_index[fileName] = (keystrokeCount, fileInfoData)
         else:
             # update the end and local_end to zero since the file is still getting modified
-            fileInfoData['end'] = 0
-            fileInfoData['local_end'] = 0
+            fileInfoData.end = 0
+            fileInfoData.local_end = 0
 
     @staticmethod
-    def get_file_info_and_initialize_if_none(keystrokeCount, fileName):
+    def get_file_info_and_initialize_if_none(keystrokeCount, fileName, now=None):
         fileInfoData = PluginData.get_existing_file_info(fileName)
         if fileInfoData is None:
-            PluginData.initialize_file_info(keystrokeCount, fileName)
+            PluginData.initialize_file_info(keystrokeCount, fileName, now)
             fileInfoData = PluginData.get_existing_file_info(fileName)
 
+        PluginData.focus_file(fileName, now)
+
         return fileInfoData
 
     @staticmethod
@@ -298,9 +385,174 @@ class PluginData():
         active_data = PluginData.create_empty_payload(fileName, "Unnamed")
         PluginData.get_file_info_and_initialize_if_none(active_data, fileName)
         fileInfoData = PluginData.get_existing_file_info(fileName)
-        fileInfoData['add'] = 1
+        fileInfoData.add = 1
         active_data.keystrokes = 1
-        PluginData.send_all_datas()
+        PluginData.flush_all()
+
+    # capture what the aggregator needs from the view, it can be closed
+    # or changed by the time the event gets aggregated
+    @staticmethod
+    def capture_event(kind, view):
+        fileName = view.file_name()
+        if (fileName is None):
+            fileName = "Untitled"
+
+        windowId = None
+        variables = None
+        window = view.window()
+        if window is not None:
+            windowId = window.id()
+            if not PluginData.has_project(windowId, fileName):
+                variables = window.extract_variables()
+
+        syntax = None
+        if kind == MODIFIED_EVENT:
+            syntax = view.settings().get('syntax')
+
+        fileSize = view.size()
+        # rowcol(point) Calculates the 0-based line and column numbers of the point
+        lines = view.rowcol(fileSize)[0]
+        PluginData.event_aggregator.push((kind, fileName, windowId, variables, syntax, fileSize, lines, round(time.time())))
+
+    # runs on the event aggregator thread
+    @staticmethod
+    def aggregate_events(batch):
+        for event in batch:
+            # (kind, fileName, windowId, variables, syntax, fileSize, lines, now)
+            kind = event[0]
+            if kind == MODIFIED_EVENT:
+                PluginData.record_modified(*event[1:])
+            elif kind == OPEN_EVENT:
+                PluginData.record_open(*event[1:])
+            elif kind == CLOSE_EVENT:
+                PluginData.record_close(*event[1:])
+
+    @staticmethod
+    def focus_tracked_file(fileName, now):
+        # only files we're already tracking get their end times updated
+        if PluginData.get_existing_file_info(fileName) is not None:
+            PluginData.focus_file(fileName, now)
+
+    @staticmethod
+    def record_open(fileName, windowId, variables, syntax, fileSize, lines, now):
+        active_data = PluginData.get_active_data(fileName, windowId, variables, now)
+
+        # get the file info to increment the open metric
+        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName, now)
+        if fileInfoData is None:
+            return
+
+        fileInfoData.length = fileSize
+        fileInfoData.lines = lines
+
+        # we have the fileinfo, update the metric
+        fileInfoData.open += 1
+        log('Code Time: opened file %s' % fileName)
+
+        # show last status message
+        redispayStatus() 
+
+    @staticmethod
+    def record_close(fileName, windowId, variables, syntax, fileSize, lines, now):
+        active_data = PluginData.get_active_data(fileName, windowId, variables, now)
+
+        # get the file info to increment the close metric
+        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName, now)
+        if fileInfoData is None:
+            return
+
+        fileInfoData.length = fileSize
+        fileInfoData.lines = lines
+
+        # we have the fileInfo, update the metric
+        fileInfoData.close += 1
+        log('Code Time: closed file %s' % fileName)
+        
+        # show last status message
+        redispayStatus() 
+
+    @staticmethod
+    def record_modified(fileName, windowId, variables, syntax, fileSize, lines, now):
+        global PROJECT_DIR
+        # get active data will create the file info if it doesn't exist
+        active_data = PluginData.get_active_data(fileName, windowId, variables, now)
+        if active_data is None:
+            return
+
+        # add the count for the file
+        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName, now)
+        if fileInfoData is None:
+            return
+
+        prevLines = fileInfoData.lines
+        if (prevLines <= 0):
+            # unknown for this interval, use the last known count
+            knownLines = PluginData.line_counts.get(fileName)
+            if (knownLines is not None and knownLines > 0):
+                prevLines = knownLines
+                fileInfoData.lines = prevLines
+
+        lineDiff = 0
+        if (prevLines > 0):
+            lineDiff = lines - prevLines
+            if (lineDiff > 0):
+                fileInfoData.linesAdded += lineDiff
+                log('Code Time: linesAdded incremented')
+            elif (lineDiff < 0):
+                fileInfoData.linesRemoved += abs(lineDiff)
+                log('Code Time: linesRemoved incremented')
+
+        fileInfoData.lines = lines
+        
+        # subtract the current size of the file from what we had before
+        # we'll know whether it's a delete, copy+paste, or kpm.
+        currLen = fileInfoData.length
+
+        charCountDiff = 0
+        
+        if currLen > 0:
+            charCountDiff = fileSize - currLen
+
+        if (not fileInfoData.syntax and syntax):
+            # get the last occurance of the "/" then get the 1st occurance of the .sublime-syntax
+            # [language].sublime-syntax
+            # Packages/Python/Python.sublime-syntax
+            syntax = syntax[syntax.rfind('/') + 1:-len(".sublime-syntax")]
+            if (syntax):
+                fileInfoData.syntax = syntax
+
+        PROJECT_DIR = active_data.project['directory']
+
+        # getCachedResourceInfo is a SoftwareUtil function, it returns None
+        # while the repo info is still being resolved in the background
+        if (active_data.project.get("identifier") is None):
+            resourceInfoDict = getCachedResourceInfo(PROJECT_DIR)
+            if (resourceInfoDict is not None and resourceInfoDict.get("identifier") is not None):
+                active_data.project['identifier'] = resourceInfoDict['identifier']
+                active_data.project['resource'] = resourceInfoDict
+
+        
+        fileInfoData.length = fileSize
+
+        if lineDiff == 0 and charCountDiff > 8:
+            fileInfoData.paste += 1
+            log('Code Time: pasted incremented')
+        elif lineDiff == 0 and charCountDiff == -1:
+            fileInfoData.delete += 1
+            log('Code Time: delete incremented')
+        elif lineDiff == 0 and charCountDiff == 1:
+            fileInfoData.add += 1
+            log('Code Time: KPM incremented')
+
+        # increment the overall count
+        if (charCountDiff != 0 or lineDiff != 0):
+            active_data.keystrokes += 1
+
+        # update the netkeys and the keys
+        # "netkeys" = add - delete
+        fileInfoData.netkeys = fileInfoData.add - fileInfoData.delete
+
+PluginData.event_aggregator = EventAggregator(PluginData.aggregate_events)
 
 class GoToSoftwareCommand(sublime_plugin.TextCommand):
     def run(self, edit):
@@ -330,7 +582,8 @@ class CodeTimeLogin(sublime_plugin.TextCommand):
 # Command to launch the code time metrics "launch_code_time_metrics"
 class LaunchCodeTimeMetrics(sublime_plugin.TextCommand):
     def run(self, edit):
-        launchCodeTimeMetrics()
+        # the dashboard requests can take a while, keep the ui responsive
+        sublime.set_timeout_async(launchCodeTimeMetrics, 0)
 
 class LaunchCustomDashboard(sublime_plugin.WindowCommand):
     def run(self):
@@ -344,7 +597,7 @@ class LaunchCustomDashboard(sublime_plugin.WindowCommand):
 
     def on_done(self, result):
         setValue("date_range", result)
-        launchCustomDashboard()
+        sublime.set_timeout_async(launchCustomDashboard, 0)
 
 
 class SoftwareTopForty(sublime_plugin.TextCommand):
@@ -406,151 +659,34 @@ class EnableKpmUpdatesCommand(sublime_plugin.TextCommand):
     def is_enabled(self):
         return (getValue("software_telemetry_on", True) is False)
 
-# Runs once instance per view (i.e. tab, or single file window)
+# Runs once instance per view (i.e. tab, or single file window).
+# The listener only captures the view state, the event aggregator
+# thread does the rest.
 class EventListener(sublime_plugin.EventListener):
-    def on_load_async(self, view):
+    def on_activated_async(self, view):
         fileName = view.file_name()
         if (fileName is None):
             fileName = "Untitled"
 
-        active_data = PluginData.get_active_data(view)
-
-        # get the file info to increment the open metric
-        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName)
-        if fileInfoData is None:
-            return
-
-        fileSize = view.size()
-        fileInfoData['length'] = fileSize
+        window = view.window()
+        if window is not None:
+            PluginData.event_aggregator.call(PluginData.invalidate_projects, window.id())
 
-        # get the number of lines
-        lines = view.rowcol(fileSize)[0]
-        fileInfoData['lines'] = lines
+        PluginData.event_aggregator.call(PluginData.focus_tracked_file, fileName, round(time.time()))
 
-        # we have the fileinfo, update the metric
-        fileInfoData['open'] += 1
-        log('Code Time: opened file %s' % fileName)
+    def on_post_window_command(self, window, command_name, args):
+        # the folders or the project of the window changed
+        if command_name in PROJECT_WINDOW_COMMANDS:
+            PluginData.event_aggregator.call(PluginData.invalidate_projects, window.id())
 
-        # show last status message
-        redispayStatus() 
+    def on_load_async(self, view):
+        PluginData.capture_event(OPEN_EVENT, view)
 
     def on_close(self, view):
-        fileName = view.file_name()
-        if (fileName is None):
-            fileName = "Untitled"
-
-        active_data = PluginData.get_active_data(view)
-
-        # get the file info to increment the close metric
-        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName)
-        if fileInfoData is None:
-            return
-
-        fileSize = view.size()
-        fileInfoData['length'] = fileSize
-
-        # get the number of lines
-        lines = view.rowcol(fileSize)[0]
-        fileInfoData['lines'] = lines
-
-        # we have the fileInfo, update the metric
-        fileInfoData['close'] += 1
-        log('Code Time: closed file %s' % fileName)
-        
-        # show last status message
-        redispayStatus() 
+        PluginData.capture_event(CLOSE_EVENT, view)
 
     def on_modified_async(self, view):
-        global PROJECT_DIR
-        # get active data will create the file info if it doesn't exist
-        active_data = PluginData.get_active_data(view)
-        if active_data is None:
-            return
-
-        # add the count for the file
-        fileName = view.file_name()
-        if (fileName is None):
-            fileName = "Untitled"
-        fileInfoData = PluginData.get_file_info_and_initialize_if_none(active_data, fileName)
-        if fileInfoData is None:
-            return
-
-        fileSize = view.size()
-
-        lines = 0
-        # try..
-        # rowcol(point) Calculates the 0-based line and column numbers of the point
-        lines = view.rowcol(fileSize)[0]
-
-        prevLines = fileInfoData['lines']
-        if (prevLines == 0):
-
-            if (PluginData.line_counts.get(fileName) is None):
-                PluginData.line_counts[fileName] = prevLines
-
-            prevLines = PluginData.line_counts[fileName]
-            if (prevLines > 0):
-                fileInfoData['lines'] = prevLines
-
-        lineDiff = 0
-        if (prevLines > 0):
-            lineDiff = lines - prevLines
-            if (lineDiff > 0):
-                fileInfoData['linesAdded'] += lineDiff
-                log('Code Time: linesAdded incremented')
-            elif (lineDiff < 0):
-                fileInfoData['linesRemoved'] += abs(lineDiff)
-                log('Code Time: linesRemoved incremented')
-
-        fileInfoData['lines'] = lines
-        
-        # subtract the current size of the file from what we had before
-        # we'll know whether it's a delete, copy+paste, or kpm.
-        currLen = fileInfoData['length']
-
-        charCountDiff = 0
-        
-        if currLen > 0:
-            charCountDiff = fileSize - currLen
-
-        if (not fileInfoData["syntax"]):
-            syntax = view.settings().get('syntax')
-            # get the last occurance of the "/" then get the 1st occurance of the .sublime-syntax
-            # [language].sublime-syntax
-            # Packages/Python/Python.sublime-syntax
-            syntax = syntax[syntax.rfind('/') + 1:-len(".sublime-syntax")]
-            if (syntax):
-                fileInfoData["syntax"] = syntax
-
-        PROJECT_DIR = active_data.project['directory']
-
-        # getResourceInfo is a SoftwareUtil function
-        if (active_data.project.get("identifier") is None):
-            resourceInfoDict = getResourceInfo(PROJECT_DIR)
-            if (resourceInfoDict.get("identifier") is not None):
-                active_data.project['identifier'] = resourceInfoDict['identifier']
-                active_data.project['resource'] = resourceInfoDict
-
-        
-        fileInfoData['length'] = fileSize
-
-        if lineDiff == 0 and charCountDiff > 8:
-            fileInfoData['paste'] += 1
-            log('Code Time: pasted incremented')
-        elif lineDiff == 0 and charCountDiff == -1:
-            fileInfoData['delete'] += 1
-            log('Code Time: delete incremented')
-        elif lineDiff == 0 and charCountDiff == 1:
-            fileInfoData['add'] += 1
-            log('Code Time: KPM incremented')
-
-        # increment the overall count
-        if (charCountDiff != 0 or lineDiff != 0):
-            active_data.keystrokes += 1
-
-        # update the netkeys and the keys
-        # "netkeys" = add - delete
-        fileInfoData['netkeys'] = fileInfoData['add'] - fileInfoData['delete']
+        PluginData.capture_event(MODIFIED_EVENT, view)
 
 #
 # Iniates the plugin tasks once the it's loaded into Sublime.
@@ -568,15 +704,13 @@ def initializeUser():
         if (serverAvailable is False):
             if (retry_counter == 0):
                 showOfflinePrompt()
-            initializeUserTimer = Timer(check_online_interval_sec, initializeUser)
-            initializeUserTimer.start()
+            runLater(check_online_interval_sec, initializeUser, blocking=True)
         else:
             result = createAnonymousUser(serverAvailable)
             if (result is None):
                 if (retry_counter == 0):
                     showOfflinePrompt()
-                initializeUserTimer = Timer(check_online_interval_sec, initializeUser)
-                initializeUserTimer.start()
+                runLater(check_online_interval_sec, initializeUser, blocking=True)
             else:
                 initializePlugin(True, serverAvailable)
     else:
@@ -589,19 +723,20 @@ def initializePlugin(initializedAnonUser, serverAvailable):
 
     setItem("sublime_lastUpdateTime", None)
 
-    # fire off timer tasks (seconds, task)
+    # register the periodic tasks (interval, task, first run), the ones
+    # waiting on the network or git run on the scheduler's workers
 
-    setOnlineStatusTimer = Timer(2, setOnlineStatus)
-    setOnlineStatusTimer.start()
+    # check the online status every minute
+    runEvery(60, setOnlineStatus, 2, blocking=True)
 
-    sendOfflineDataTimer = Timer(10, sendOfflineData)
-    sendOfflineDataTimer.start()
+    # send the offline data every 30 minutes
+    runEvery(60 * 30, sendOfflineData, 10, jitter=30, blocking=True)
 
-    gatherMusicTimer = Timer(45, gatherMusicInfo)
-    gatherMusicTimer.start()
+    # check the playing track every 15 seconds
+    runEvery(15, gatherMusicInfo, 45, blocking=True)
 
-    hourlyTimer = Timer(60, hourlyTimerHandler)
-    hourlyTimer.start()
+    # gather the git commits, repo members, heatbeat ping every hour
+    runEvery(60 * 60, hourlyTimerHandler, 60, jitter=30, blocking=True)
 
     initializeUserInfo(initializedAnonUser)
 
@@ -610,31 +745,41 @@ def initializeUserInfo(initializedAnonUser):
 
     if (initializedAnonUser is True):
         showLoginPrompt()
-        PluginData.send_initial_payload()
+        PluginData.event_aggregator.call(PluginData.send_initial_payload)
 
-    sendInitHeartbeatTimer = Timer(15, sendInitializedHeartbeat)
-    sendInitHeartbeatTimer.start()
+    runLater(15, sendInitializedHeartbeat, blocking=True)
 
-    # re-fetch user info in another 90 seconds
-    checkUserAuthTimer = Timer(90, userStatusHandler)
-    checkUserAuthTimer.start()
+    # re-fetch user info in another 90 seconds, then every 10 minutes
+    global user_status_job
+    user_status_job = runEvery(60 * 10, userStatusHandler, 90, blocking=True)
 
 def userStatusHandler():
     getUserStatus()
 
     loggedOn = getValue("logged_on", True)
-    if (loggedOn is True):
+    if (loggedOn is True and user_status_job is not None):
         # no need to fetch any longer
-        return
-    
-    # re-fetch user info in another 10 minutes
-    checkUserAuthTimer = Timer(60 * 10, userStatusHandler)
-    checkUserAuthTimer.start()
+        user_status_job.cancel()
 
 def plugin_unloaded():
+    # stop the scheduled tasks
+    stopScheduler()
+
+    # aggregate the remaining editor events
+    PluginData.event_aggregator.stop()
+    PluginData.line_counts.save(True)
+
     # clean up the background worker
     PluginData.background_worker.queue.join()
 
+    # make sure the stored payloads are on disk
+    offlineJournal.close()
+    sessionCache.save()
+    sessionSummary.save()
+    metricsStore.close()
+    networkEngine.stop()
+    closeConnections()
+
 def sendInitializedHeartbeat():
     sendHeartbeat("INITIALIZED")
 
@@ -643,12 +788,7 @@ def hourlyTimerHandler():
     sendHeartbeat("HOURLY")
 
     # process commits in a minute
-    processCommitsTimer = Timer(60, processCommits)
-    processCommitsTimer.start()
-
-    # run the handler in another hour
-    hourlyTimer = Timer(60 * 60, hourlyTimerHandler)
-    hourlyTimer.start()
+    runLater(60, processCommits, blocking=True)
 
 # ...
 def processCommits():
@@ -659,18 +799,14 @@ def showOfflinePrompt():
     infoMsg = "Our service is temporarily unavailable. We will try to reconnect again in 10 minutes. Your status bar will not update at this time."
     sublime.message_dialog(infoMsg)
 
+# pings when the recent requests don't tell whether the api is
+# reachable, which also probes it while requests to it are paused
 def setOnlineStatus():
-    online = checkOnline()
     log("Code Time: Checking online status...")
-    if (online is True):
-        setValue("online", True)
+    checkOnline()
+    if (isApiAvailable()):
         log("Code Time: Online")
     else:
-        setValue("online", False)
         log("Code Time: Offline")
 
-    # run the check in another 1 minute
-    timer = Timer(60 * 1, setOnlineStatus)
-    timer.start()
-
 
@@ -0,0 +1,317 @@
+# Copyright (c) 2018 by Software.com
+#
+# Replays editor event traces through the plugin outside of Sublime Text
+# and reports the per-event latency, allocations and throughput of the
+# keystroke capture, the aggregation and the minute flushes.
+#
+#   python bench/bench_events.py                   all synthetic traces
+#   python bench/bench_events.py typing paste      selected traces
+#   python bench/bench_events.py --trace my.jsonl  a recorded trace
+#
+# A recorded trace has one json event per line:
+#   {"kind": "modified", "window": 1, "folder": "/src/app",
+#    "file": "/src/app/main.py", "size": 1200, "lines": 40}
+# kind is one of open, close, modified or flush.
+#
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCH_DIR)
+PACKAGE_NAME = 'CodeTime'
+
+# events per simulated minute between flushes
+EVENTS_PER_FLUSH = 2000
+
+def loadPlugin(homeDir):
+    sys.path.insert(0, os.path.join(BENCH_DIR, 'stubs'))
+    os.environ['HOME'] = homeDir
+    os.environ['USERPROFILE'] = homeDir
+
+    import sublime
+    settings = sublime.load_settings("Software.sublime_settings")
+    # no console output or network calls while measuring
+    settings.set("software_logging_on", False)
+    settings.set("software_telemetry_on", False)
+
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [PACKAGE_DIR]
+    sys.modules[PACKAGE_NAME] = package
+
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME + '.Software', os.path.join(PACKAGE_DIR, 'Software.py'))
+    plugin = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = plugin
+    spec.loader.exec_module(plugin)
+
+    # the bench drives the aggregation itself
+    plugin.PluginData.event_aggregator.stop()
+    return plugin
+
+#
+# synthetic traces, lists of (kind, window, folder, file, size, lines)
+#
+
+def typingTrace(count):
+    events = []
+    files = ['/bench/app/src/file%d.py' % i for i in range(3)]
+    state = dict((f, [4000, 100]) for f in files)
+    for f in files:
+        events.append(('open', 1, '/bench/app', f, state[f][0], state[f][1]))
+    current = files[0]
+    for i in range(count):
+        if (i % 500 == 0):
+            current = random.choice(files)
+        size, lines = state[current]
+        r = random.random()
+        if (r < 0.08):
+            size -= 1
+        elif (r < 0.11):
+            size += 1
+            lines += 1
+        else:
+            size += 1
+        state[current] = [size, lines]
+        events.append(('modified', 1, '/bench/app', current, size, lines))
+    return events
+
+def pasteTrace(count):
+    events = []
+    fileName = '/bench/app/src/paste.py'
+    size, lines = 2000, 50
+    events.append(('open', 1, '/bench/app', fileName, size, lines))
+    for i in range(count):
+        if (i % 10 == 0):
+            pasted = random.randint(200, 2000)
+            size += pasted
+            lines += pasted // 40
+        else:
+            size += 1
+        events.append(('modified', 1, '/bench/app', fileName, size, lines))
+    return events
+
+def multiFileReplaceTrace(count):
+    events = []
+    fileCount = max(1, count // 2)
+    for i in range(fileCount):
+        fileName = '/bench/mono/pkg%d/module%d.py' % (i % 40, i)
+        events.append(('open', 1, '/bench/mono', fileName, 3000, 80))
+        events.append(('modified', 1, '/bench/mono', fileName, 2997, 80))
+    return events[:count]
+
+def manyProjectsTrace(count):
+    events = []
+    projects = 50
+    filesPerProject = 20
+    state = {}
+    for i in range(count):
+        project = random.randrange(projects)
+        folder = '/bench/project%d' % project
+        fileName = '%s/src/file%d.py' % (folder, random.randrange(filesPerProject))
+        size, lines = state.get(fileName, (1000, 30))
+        size += 1
+        state[fileName] = (size, lines)
+        events.append(('modified', project + 1, folder, fileName, size, lines))
+    return events
+
+TRACES = {
+    'typing': typingTrace,
+    'paste': pasteTrace,
+    'multi_file_replace': multiFileReplaceTrace,
+    'many_projects': manyProjectsTrace,
+}
+
+def readTrace(file):
+    events = []
+    with open(file) as f:
+        for line in f:
+            line = line.strip()
+            if (not line):
+                continue
+            event = json.loads(line)
+            events.append((event['kind'], event.get('window', 1), event.get('folder'),
+                event.get('file'), event.get('size', 0), event.get('lines', 0)))
+    return events
+
+#
+# replay
+#
+
+class Replay():
+    def __init__(self, plugin):
+        import sublime
+        self.sublime = sublime
+        self.plugin = plugin
+        self.listener = plugin.EventListener()
+        self.windows = {}
+        self.views = {}
+
+    def view(self, windowKey, folder, fileName):
+        window = self.windows.get(windowKey)
+        if (window is None):
+            folders = [folder] if folder else []
+            window = self.sublime.Window(folders)
+            self.windows[windowKey] = window
+        view = self.views.get((windowKey, fileName))
+        if (view is None):
+            view = self.sublime.View(window, fileName)
+            self.views[(windowKey, fileName)] = view
+        return view
+
+    def capture(self, event):
+        kind, windowKey, folder, fileName, size, lines = event
+        view = self.view(windowKey, folder, fileName)
+        view.length = size
+        view.lines = lines
+        if (kind == 'modified'):
+            self.listener.on_modified_async(view)
+        elif (kind == 'open'):
+            self.listener.on_load_async(view)
+        elif (kind == 'close'):
+            self.listener.on_close(view)
+
+def percentile(samples, pct):
+    if (not samples):
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+def replayEvents(plugin, events, captureTimes, aggregateTimes, flushTimes):
+    PluginData = plugin.PluginData
+    buffer = PluginData.event_aggregator.buffer
+    replay = Replay(plugin)
+    perf = time.perf_counter
+
+    sinceFlush = 0
+    for event in events:
+        if (event[0] == 'flush'):
+            sinceFlush = EVENTS_PER_FLUSH
+        else:
+            t0 = perf()
+            replay.capture(event)
+            captureTimes.append(perf() - t0)
+
+            for captured in buffer.drain(1):
+                t0 = perf()
+                PluginData.aggregate_events([captured])
+                aggregateTimes.append(perf() - t0)
+            sinceFlush += 1
+
+        if (sinceFlush >= EVENTS_PER_FLUSH):
+            sinceFlush = 0
+            t0 = perf()
+            PluginData.flush_all()
+            flushTimes.append(perf() - t0)
+
+def resetPlugin(plugin):
+    PluginData = plugin.PluginData
+    # let the payload writer catch up before the next run
+    PluginData.flush_all()
+    PluginData.background_worker.queue.join()
+    PluginData.invalidate_projects()
+
+def runTrace(plugin, name, events):
+    captureTimes = []
+    aggregateTimes = []
+    flushTimes = []
+
+    # timed run
+    started = time.perf_counter()
+    replayEvents(plugin, events, captureTimes, aggregateTimes, flushTimes)
+    elapsed = time.perf_counter() - started
+    resetPlugin(plugin)
+
+    # allocation run, tracemalloc slows everything down
+    # so it gets its own replay of the same trace
+    tracemalloc.start()
+    startSnapshot = tracemalloc.take_snapshot()
+    replayEvents(plugin, events, [], [], [])
+    endSnapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    resetPlugin(plugin)
+
+    stats = endSnapshot.compare_to(startSnapshot, 'filename')
+    retained = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+
+    count = len(captureTimes)
+    return {
+        'trace': name,
+        'events': count,
+        'capture_p50_us': percentile(captureTimes, 50) * 1e6,
+        'capture_p99_us': percentile(captureTimes, 99) * 1e6,
+        'aggregate_p50_us': percentile(aggregateTimes, 50) * 1e6,
+        'aggregate_p99_us': percentile(aggregateTimes, 99) * 1e6,
+        'flush_p50_ms': percentile(flushTimes, 50) * 1e3,
+        'flush_p99_ms': percentile(flushTimes, 99) * 1e3,
+        'events_per_sec': count / elapsed if elapsed > 0 else 0.0,
+        'retained_bytes_per_event': retained / float(count) if count else 0.0,
+        'peak_kib': peak / 1024.0,
+    }
+
+def printResults(results):
+    columns = [
+        ('trace', '%-20s'),
+        ('events', '%8d'),
+        ('capture_p50_us', '%10.1f'),
+        ('capture_p99_us', '%10.1f'),
+        ('aggregate_p50_us', '%10.1f'),
+        ('aggregate_p99_us', '%10.1f'),
+        ('flush_p50_ms', '%9.2f'),
+        ('flush_p99_ms', '%9.2f'),
+        ('events_per_sec', '%12.0f'),
+        ('retained_bytes_per_event', '%9.1f'),
+        ('peak_kib', '%10.1f'),
+    ]
+    headers = ['trace', 'events', 'cap p50us', 'cap p99us', 'agg p50us', 'agg p99us',
+        'flush p50', 'flush p99', 'events/s', 'B/event', 'peak KiB']
+    widths = [len(fmt % (0 if 'd' in fmt or 'f' in fmt else '')) for key, fmt in columns]
+    print('  '.join(h.rjust(w) if i else h.ljust(w) for i, (h, w) in enumerate(zip(headers, widths))))
+    for result in results:
+        print('  '.join(fmt % result[key] for key, fmt in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay editor event traces through the Code Time plugin.')
+    parser.add_argument('traces', nargs='*', help='synthetic traces to run: %s' % ', '.join(sorted(TRACES)))
+    parser.add_argument('--trace', dest='traceFile', help='replay a recorded json lines trace')
+    parser.add_argument('--events', type=int, default=20000, help='events per synthetic trace')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    homeDir = tempfile.mkdtemp(prefix='codetime-bench-')
+    try:
+        plugin = loadPlugin(homeDir)
+
+        runs = []
+        if (args.traceFile):
+            runs.append((os.path.basename(args.traceFile), readTrace(args.traceFile)))
+        names = args.traces or ([] if args.traceFile else sorted(TRACES))
+        for name in names:
+            if (name not in TRACES):
+                parser.error('unknown trace %s' % name)
+            runs.append((name, TRACES[name](args.events)))
+
+        results = [runTrace(plugin, name, events) for name, events in runs]
+        if (args.json):
+            print(json.dumps(results, indent=2))
+        else:
+            printResults(results)
+
+        plugin.plugin_unloaded()
+    finally:
+        shutil.rmtree(homeDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Copyright (c) 2018 by Software.com
+#
+# Fills the offline journal with a backlog of kpm payloads and uploads it
+# to a local stand-in api, reporting the bytes kept on disk, the bytes
+# sent, the requests made and the connections opened for them, with and
+# without the hourly rollups.
+#
+#   python bench/bench_upload.py
+#   python bench/bench_upload.py --payloads 20000 --latency 0.05
+#   python bench/bench_upload.py --max-body-kb 256
+#
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bench_events import loadPlugin
+from fake_api import FakeApiServer
+
+# uploads tried per row, as the plugin would every half hour
+UPLOAD_ATTEMPTS = 10
+
+def makePayload(minute, project):
+    start = 1560000000 + minute * 60
+    source = {}
+    for i in range(random.randint(1, 4)):
+        fileName = '/Users/dev/workspace/%s/src/components/module_%d/index.js' % (project, random.randrange(40))
+        add = random.randint(0, 120)
+        delete = random.randint(0, 20)
+        source[fileName] = {
+            'paste': random.randint(0, 2), 'open': random.randint(0, 1), 'close': 0,
+            'length': random.randint(1000, 40000), 'delete': delete, 'netkeys': add - delete,
+            'add': add, 'lines': random.randint(50, 900), 'linesAdded': random.randint(0, 6),
+            'linesRemoved': random.randint(0, 3), 'syntax': 'JavaScript',
+            'start': start, 'local_start': start - 25200, 'end': start + 60, 'local_end': start - 25140,
+        }
+    return {
+        'source': source,
+        'keystrokes': sum(f['add'] + f['delete'] for f in source.values()),
+        'start': start, 'local_start': start - 25200,
+        'project': {'directory': '/Users/dev/workspace/%s' % project, 'name': project},
+        'pluginId': 1, 'version': '0.9.4', 'os': 'Darwin_18.6.0', 'timezone': 'PDT',
+    }
+
+def dirSize(directory):
+    total = 0
+    for name in os.listdir(directory):
+        total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+def runUpload(plugin, server, payloads, compressDisk, gzipRequests, compact):
+    import sublime
+    settings = sublime.load_settings("Software.sublime_settings")
+    settings.set("software_compress_offline_data", compressDisk)
+    settings.set("software_gzip_requests", gzipRequests)
+
+    journal = plugin.offlineJournal
+    for i in range(0, len(payloads), 10):
+        journal.append(payloads[i:i + 10])
+    journal.seal()
+    # the backlog sat offline for a day, so its segments get compressed
+    idleTime = time.time() - 24 * 60 * 60
+    for name in os.listdir(journal.getDir()):
+        os.utime(os.path.join(journal.getDir(), name), (idleTime, idleTime))
+    journal.seal()
+
+    server.stats.reset()
+    started = time.perf_counter()
+    if (compact):
+        journal.compact(0)
+        journal.seal()
+    diskBytes = dirSize(journal.getDir())
+    # a failed batch ends the upload, the next one sends it again
+    for attempt in range(UPLOAD_ATTEMPTS):
+        ok = journal.upload(plugin.sendOfflineBatch)
+        if (ok):
+            break
+    elapsed = time.perf_counter() - started
+    stats = server.stats.snapshot()
+
+    return {
+        'compress_disk': compressDisk,
+        'gzip_requests': gzipRequests,
+        'compact': compact,
+        'uploaded': ok and (compact or stats['payloads'] >= len(payloads)),
+        'payloads': stats['payloads'],
+        'disk_bytes': diskBytes,
+        'requests': stats['requests'],
+        'rejected': stats['rejected_requests'],
+        'connections': stats['connections'],
+        'wire_bytes': stats['wire_bytes'],
+        'body_bytes': stats['body_bytes'],
+        'seconds': elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload an offline backlog to a local stand-in api.')
+    parser.add_argument('--payloads', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in api waits per response')
+    parser.add_argument('--max-body-kb', type=int, default=0, help='the stand-in api refuses bigger request bodies')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    payloads = [json.dumps(makePayload(i, 'project%d' % (i % 3))) for i in range(args.payloads)]
+
+    homeDir = tempfile.mkdtemp(prefix='codetime-bench-')
+    server = FakeApiServer(latency=args.latency, maxBodyBytes=args.max_body_kb * 1024).start()
+    try:
+        plugin = loadPlugin(homeDir)
+        import sublime
+        settings = sublime.load_settings("Software.sublime_settings")
+        settings.set("software_telemetry_on", True)
+        settings.set("software_api_endpoint", server.endpoint)
+        plugin.setItem("jwt", "bench-jwt")
+
+        results = []
+        for compressDisk, gzipRequests, compact in [(False, False, False), (True, False, False),
+                (True, True, False), (True, True, True)]:
+            results.append(runUpload(plugin, server, payloads, compressDisk, gzipRequests, compact))
+
+        if (args.json):
+            print(json.dumps(results, indent=2))
+        else:
+            print('%-10s %-14s %-8s %9s %9s %12s %9s %9s %12s %12s %12s %9s' % ('disk zlib', 'gzip requests', 'rollups',
+                'uploaded', 'payloads', 'disk bytes', 'requests', 'refused', 'connections', 'wire bytes', 'json bytes',
+                'seconds'))
+            for r in results:
+                print('%-10s %-14s %-8s %9s %9d %12d %9d %9d %12d %12d %12d %9.2f' % (r['compress_disk'], r['gzip_requests'],
+                    r['compact'], r['uploaded'], r['payloads'], r['disk_bytes'], r['requests'], r['rejected'],
+                    r['connections'], r['wire_bytes'], r['body_bytes'], r['seconds']))
+
+        plugin.plugin_unloaded()
+    finally:
+        server.stop()
+        shutil.rmtree(homeDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Copyright (c) 2018 by Software.com
+#
+# Local stand-in for the Code Time api used by the benchmarks. It accepts
+# any request, decodes gzip bodies and counts connections, requests and
+# bytes so the network side of the plugin can be measured offline.
+# Requests with a body over the optional limit are refused with a 413.
+#
+import gzip
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class FakeApiStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.wireBytes = 0
+            self.bodyBytes = 0
+            self.gzipRequests = 0
+            self.payloads = 0
+            self.rejectedRequests = 0
+            self.paths = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'requests': self.requests,
+                'wire_bytes': self.wireBytes,
+                'body_bytes': self.bodyBytes,
+                'gzip_requests': self.gzipRequests,
+                'payloads': self.payloads,
+                'rejected_requests': self.rejectedRequests,
+                'paths': dict(self.paths),
+            }
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, without this
+    # every response waits on the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        stats = self.server.stats
+        with stats.lock:
+            stats.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def handle_request(self):
+        stats = self.server.stats
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length) if length else b''
+        wireBytes = len(body)
+        isGzip = self.headers.get('Content-Encoding') == 'gzip'
+        if (isGzip):
+            body = gzip.decompress(body)
+
+        payloads = 0
+        if (body):
+            try:
+                data = json.loads(body.decode('utf-8'))
+                payloads = len(data) if isinstance(data, list) else 1
+            except Exception:
+                self.respond(400, {'message': 'invalid json'})
+                return
+
+        path = self.path.split('?')[0]
+        maxBodyBytes = self.server.maxBodyBytes
+        if (maxBodyBytes and wireBytes > maxBodyBytes):
+            with stats.lock:
+                stats.rejectedRequests += 1
+            self.respond(413, {'message': 'request entity too large'})
+            return
+
+        with stats.lock:
+            stats.requests += 1
+            stats.wireBytes += wireBytes
+            stats.bodyBytes += len(body)
+            stats.payloads += payloads
+            if (isGzip):
+                stats.gzipRequests += 1
+            stats.paths[path] = stats.paths.get(path, 0) + 1
+
+        delay = self.server.latency
+        if (delay):
+            threading.Event().wait(delay)
+
+        status = self.server.statusFor(path) if self.server.statusFor else 200
+        self.respond(status, {'message': 'ok', 'status': 'success'})
+
+    def respond(self, status, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, statusFor=None, maxBodyBytes=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeApiHandler)
+        self.stats = FakeApiStats()
+        # seconds added to every response
+        self.latency = latency
+        # optional callable(path) returning the response status
+        self.statusFor = statusFor
+        # bigger request bodies get a 413, 0 for no limit
+        self.maxBodyBytes = maxBodyBytes
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return 'localhost:%d' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    # clients dropping an idle keep-alive connection aren't errors
+    def handle_error(self, request, clientAddress):
+        if (not isinstance(sys.exc_info()[1], ConnectionError)):
+            HTTPServer.handle_error(self, request, clientAddress)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,16 @@
+# Copyright (c) 2018 by Software.com
+#
+# Minimal stand-in for the package_control events module.
+#
+
+def install(name):
+    return False
+
+def post_upgrade(name):
+    return False
+
+def pre_upgrade(name):
+    return False
+
+def remove(name):
+    return False
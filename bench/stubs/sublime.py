@@ -0,0 +1,164 @@
+# Copyright (c) 2018 by Software.com
+#
+# Minimal stand-in for the sublime module so the plugin can be
+# loaded and benchmarked outside of the editor.
+#
+
+_settings = {}
+_windows = []
+
+class Settings():
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+class Window():
+    next_id = 1
+
+    def __init__(self, folders=None, project_name=None):
+        self.window_id = Window.next_id
+        Window.next_id += 1
+        self.folder_list = list(folders or [])
+        self.project_name = project_name
+        self.view_list = []
+        _windows.append(self)
+
+    def id(self):
+        return self.window_id
+
+    def folders(self):
+        return self.folder_list
+
+    def views(self):
+        return self.view_list
+
+    def active_view(self):
+        return self.view_list[-1] if self.view_list else None
+
+    def project_file_name(self):
+        if (self.project_name is None):
+            return None
+        return '/projects/%s.sublime-project' % self.project_name
+
+    def extract_variables(self):
+        variables = {'platform': 'Linux'}
+        if (self.folder_list):
+            variables['folder'] = self.folder_list[0]
+        view = self.active_view()
+        if (view is not None and view.file_name() is not None):
+            fileName = view.file_name()
+            variables['file'] = fileName
+            variables['file_path'] = fileName[:fileName.rfind('/')]
+            variables['file_name'] = fileName[fileName.rfind('/') + 1:]
+        if (self.project_name is not None):
+            variables['project_name'] = self.project_name + '.sublime-project'
+            variables['project_base_name'] = self.project_name
+        return variables
+
+    def open_file(self, fileName):
+        return View(self, fileName)
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+        return None
+
+class View():
+    next_id = 1
+
+    def __init__(self, window, fileName, size=0, lines=0, syntax='Packages/Python/Python.sublime-syntax'):
+        self.view_id = View.next_id
+        View.next_id += 1
+        self.parent = window
+        self.fileName = fileName
+        # the buffer is only tracked by its size and row count
+        self.length = size
+        self.lines = lines
+        self.view_settings = Settings({'syntax': syntax})
+        self.status = {}
+        if (window is not None):
+            window.view_list.append(self)
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.view_id
+
+    def window(self):
+        return self.parent
+
+    def file_name(self):
+        return self.fileName
+
+    def size(self):
+        return self.length
+
+    def rowcol(self, point):
+        if (point >= self.length):
+            return (self.lines, 0)
+        # assume evenly spread rows for points inside the buffer
+        if (self.length == 0):
+            return (0, 0)
+        return (self.lines * point // self.length, 0)
+
+    def settings(self):
+        return self.view_settings
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def is_valid(self):
+        return self.parent is not None
+
+def load_settings(name):
+    settings = _settings.get(name)
+    if (settings is None):
+        settings = Settings()
+        _settings[name] = settings
+    return settings
+
+def save_settings(name):
+    pass
+
+def active_window():
+    return _windows[-1] if _windows else None
+
+def windows():
+    return list(_windows)
+
+def set_timeout(callback, delay=0):
+    callback()
+
+def set_timeout_async(callback, delay=0):
+    callback()
+
+def status_message(message):
+    pass
+
+def message_dialog(message):
+    pass
+
+def ok_cancel_dialog(message, ok_title=''):
+    return False
+
+def error_message(message):
+    pass
+
+def version():
+    return '3211'
+
+def platform():
+    return 'linux'
@@ -0,0 +1,183 @@
+# Copyright (c) 2018 by Software.com
+#
+# Regression tests of reading the repo info straight from the git files.
+#
+#   python -m unittest discover -s bench -p 'test_*.py'
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+from testing import getModule
+
+HEAD_SHA = 'a' * 40
+TAG_SHA = 'b' * 40
+
+def writeFile(file, content):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+class GitConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='codetime-git-')
+        self.addCleanup(shutil.rmtree, self.dir, True)
+
+    def readConfig(self, content, name='config'):
+        G = getModule('SoftwareGit')
+        file = os.path.join(self.dir, name)
+        writeFile(file, content)
+        return G.readGitConfig(file)
+
+    def test_sections_and_subsections(self):
+        config = self.readConfig(
+            '[Core]\n'
+            '\tbare = false\n'
+            '[remote "origin"]\n'
+            '\turl = git@github.com:org/app.git\n'
+            '[branch "Feature/X"]\n'
+            '\tRemote = origin\n'
+            '[user] email = dev@example.com\n')
+        self.assertEqual(config, {
+            'core.bare': 'false',
+            'remote.origin.url': 'git@github.com:org/app.git',
+            'branch.Feature/X.remote': 'origin',
+            'user.email': 'dev@example.com',
+        })
+
+    def test_comments_and_keys_outside_sections(self):
+        config = self.readConfig(
+            'stray = value\n'
+            '# a comment\n'
+            '; another one\n'
+            '[user]\n'
+            '\tname = Dev # the name\n'
+            '\temail = dev@example.com ; work\n')
+        self.assertEqual(config, {'user.name': 'Dev', 'user.email': 'dev@example.com'})
+
+    def test_quoted_values_and_escapes(self):
+        config = self.readConfig(
+            '[alias]\n'
+            '\thash = "log # not a comment" # a comment\n'
+            '\tpath = "C:\\\\Users\\\\dev"\n'
+            '\ttab = a\\tb\n'
+            '\tquote = say \\"hi\\"\n'
+            '[section "sub \\"quoted\\""]\n'
+            '\tkey = 1\n')
+        self.assertEqual(config['alias.hash'], 'log # not a comment')
+        self.assertEqual(config['alias.path'], 'C:\\Users\\dev')
+        self.assertEqual(config['alias.tab'], 'a\tb')
+        self.assertEqual(config['alias.quote'], 'say "hi"')
+        self.assertEqual(config['section.sub "quoted".key'], '1')
+
+    def test_keys_without_a_value_are_true(self):
+        config = self.readConfig('[core]\n\tbare\n')
+        self.assertEqual(config, {'core.bare': 'true'})
+
+    def test_includes(self):
+        G = getModule('SoftwareGit')
+        writeFile(os.path.join(self.dir, 'included'), '[user]\n\temail = included@example.com\n')
+        config = self.readConfig(
+            '[user]\n'
+            '\temail = dev@example.com\n'
+            '\tname = Dev\n'
+            '[include]\n'
+            '\tpath = included\n'
+            '[includeIf "gitdir:~/work/"]\n'
+            '\tpath = ~/work.gitconfig\n')
+        # the included file overrides the keys before it, conditional
+        # includes are only kept
+        self.assertEqual(config['user.email'], 'included@example.com')
+        self.assertEqual(config['user.name'], 'Dev')
+        self.assertEqual(config['includeif.gitdir:~/work/.path'], '~/work.gitconfig')
+        self.assertNotIn('include.path', config)
+        self.assertEqual(G.readGitConfig(os.path.join(self.dir, 'missing')), {})
+
+    def test_include_cycles_end(self):
+        config = self.readConfig('[include]\n\tpath = config\n[user]\n\temail = dev@example.com\n')
+        self.assertEqual(config['user.email'], 'dev@example.com')
+
+class ResourceInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='codetime-git-')
+        self.addCleanup(shutil.rmtree, self.dir, True)
+        # no user or system config gets in the way
+        xdgHome = os.environ.get('XDG_CONFIG_HOME')
+        os.environ['XDG_CONFIG_HOME'] = os.path.join(self.dir, 'xdg')
+        self.addCleanup(self.restoreEnv, 'XDG_CONFIG_HOME', xdgHome)
+        self.repoDir = os.path.join(self.dir, 'app')
+        self.gitDir = os.path.join(self.repoDir, '.git')
+        writeFile(os.path.join(self.gitDir, 'HEAD'), 'ref: refs/heads/main\n')
+        writeFile(os.path.join(self.gitDir, 'refs', 'heads', 'main'), HEAD_SHA + '\n')
+
+    def restoreEnv(self, name, value):
+        if (value is None):
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    def writeConfig(self, content):
+        writeFile(os.path.join(self.gitDir, 'config'), '[remote "origin"]\n\turl = https://example.com/app.git\n' + content)
+
+    def test_reads_the_repo_files(self):
+        G = getModule('SoftwareGit')
+        self.writeConfig('[user]\n\temail = dev@example.com\n')
+        resourceInfo, askEmail = G.readResourceInfo(os.path.join(self.repoDir, 'src'))
+        self.assertEqual(resourceInfo, {
+            'identifier': 'https://example.com/app.git', 'branch': 'main',
+            'tag': 'heads/main', 'email': 'dev@example.com',
+        })
+        self.assertFalse(askEmail)
+
+    def test_asks_for_the_email_a_conditional_include_may_set(self):
+        G = getModule('SoftwareGit')
+        self.writeConfig('[includeIf "gitdir:~/work/"]\n\tpath = ~/work.gitconfig\n')
+        resourceInfo, askEmail = G.readResourceInfo(self.repoDir)
+        self.assertEqual(resourceInfo['identifier'], 'https://example.com/app.git')
+        self.assertNotIn('email', resourceInfo)
+        self.assertTrue(askEmail)
+
+        self.writeConfig('')
+        resourceInfo, askEmail = G.readResourceInfo(self.repoDir)
+        self.assertFalse(askEmail)
+
+    def test_no_repo(self):
+        G = getModule('SoftwareGit')
+        shutil.rmtree(self.gitDir)
+        self.assertIsNone(G.readResourceInfo(self.repoDir))
+
+    def test_tags_and_detached_head(self):
+        G = getModule('SoftwareGit')
+        self.writeConfig('')
+        writeFile(os.path.join(self.gitDir, 'packed-refs'),
+            '# pack-refs with: peeled fully-peeled sorted\n'
+            '%s refs/tags/v1.0\n'
+            '^%s\n'
+            '%s refs/tags/latest\n' % (TAG_SHA, HEAD_SHA, HEAD_SHA))
+        resourceInfo, askEmail = G.readResourceInfo(self.repoDir)
+        # the annotated tag comes before the lightweight one
+        self.assertEqual(resourceInfo['tag'], 'tags/v1.0')
+
+        writeFile(os.path.join(self.gitDir, 'HEAD'), HEAD_SHA + '\n')
+        resourceInfo, askEmail = G.readResourceInfo(self.repoDir)
+        self.assertNotIn('branch', resourceInfo)
+        self.assertEqual(resourceInfo['tag'], 'tags/v1.0')
+
+    def test_worktrees(self):
+        G = getModule('SoftwareGit')
+        self.writeConfig('')
+        worktreeGitDir = os.path.join(self.gitDir, 'worktrees', 'feature')
+        writeFile(os.path.join(worktreeGitDir, 'HEAD'), 'ref: refs/heads/feature\n')
+        writeFile(os.path.join(worktreeGitDir, 'commondir'), '../..\n')
+        writeFile(os.path.join(self.gitDir, 'refs', 'heads', 'feature'), HEAD_SHA + '\n')
+        worktreeDir = os.path.join(self.dir, 'feature')
+        writeFile(os.path.join(worktreeDir, '.git'), 'gitdir: %s\n' % worktreeGitDir)
+
+        self.assertEqual(G.getGitDir(worktreeDir), worktreeGitDir)
+        resourceInfo, askEmail = G.readResourceInfo(worktreeDir)
+        self.assertEqual(resourceInfo['identifier'], 'https://example.com/app.git')
+        self.assertEqual(resourceInfo['branch'], 'feature')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Copyright (c) 2018 by Software.com
+#
+# Regression tests of the hourly rollups of the offline payloads.
+#
+#   python -m unittest discover -s bench -p 'test_*.py'
+#
+import copy
+import unittest
+
+from testing import getModule
+
+HOUR_START = 1560000000 - 1560000000 % 3600
+UTC_OFFSET = 25200
+
+def makeFileInfo(start, add, lines, length):
+    return {
+        'add': add, 'delete': 1, 'paste': 0, 'netkeys': add - 1, 'linesAdded': 1, 'linesRemoved': 0,
+        'open': 0, 'close': 0, 'lines': lines, 'length': length, 'syntax': 'Python',
+        'start': start, 'local_start': start - UTC_OFFSET, 'end': start + 60, 'local_end': start + 60 - UTC_OFFSET,
+    }
+
+def makePayload(start, source, project='/test/app'):
+    return {
+        'source': source, 'keystrokes': sum(f['add'] + f['delete'] for f in source.values()),
+        'start': start, 'local_start': start - UTC_OFFSET,
+        'project': {'directory': project, 'name': 'app'},
+    }
+
+class RollupTest(unittest.TestCase):
+    def test_merges_the_payloads_of_an_hour(self):
+        R = getModule('SoftwareRollup')
+        first = makePayload(HOUR_START + 600, {'a.py': makeFileInfo(HOUR_START + 600, 10, 100, 2000)})
+        second = makePayload(HOUR_START + 60, {
+            'a.py': makeFileInfo(HOUR_START + 60, 5, 90, 1800),
+            'b.py': makeFileInfo(HOUR_START + 60, 3, 20, 300),
+        })
+        third = makePayload(HOUR_START + 1200, {'a.py': makeFileInfo(HOUR_START + 1200, 7, 120, 2400)})
+        payloads = [first, second, third]
+        original = copy.deepcopy(payloads)
+
+        rollups = R.rollupPayloads(payloads)
+        self.assertEqual(payloads, original)
+        self.assertEqual(len(rollups), 1)
+        rollup = rollups[0]
+        # the earliest start, the summed keystrokes
+        self.assertEqual(rollup['start'], HOUR_START + 60)
+        self.assertEqual(rollup['local_start'], HOUR_START + 60 - UTC_OFFSET)
+        self.assertEqual(rollup['keystrokes'], sum(p['keystrokes'] for p in payloads))
+
+        fileInfo = rollup['source']['a.py']
+        self.assertEqual(fileInfo['add'], 22)
+        self.assertEqual(fileInfo['delete'], 3)
+        self.assertEqual(fileInfo['netkeys'], 19)
+        self.assertEqual(fileInfo['linesAdded'], 3)
+        self.assertEqual(fileInfo['start'], HOUR_START + 60)
+        self.assertEqual(fileInfo['local_start'], HOUR_START + 60 - UTC_OFFSET)
+        # the file as it was at the latest end
+        self.assertEqual(fileInfo['end'], HOUR_START + 1260)
+        self.assertEqual(fileInfo['local_end'], HOUR_START + 1260 - UTC_OFFSET)
+        self.assertEqual(fileInfo['lines'], 120)
+        self.assertEqual(fileInfo['length'], 2400)
+        self.assertEqual(rollup['source']['b.py'], second['source']['b.py'])
+
+    def test_keeps_projects_and_hours_apart(self):
+        R = getModule('SoftwareRollup')
+        payloads = [
+            makePayload(HOUR_START + 60, {'a.py': makeFileInfo(HOUR_START + 60, 1, 10, 100)}),
+            makePayload(HOUR_START + 3600, {'a.py': makeFileInfo(HOUR_START + 3600, 1, 10, 100)}),
+            makePayload(HOUR_START + 120, {'a.py': makeFileInfo(HOUR_START + 120, 1, 10, 100)}, '/test/other'),
+            makePayload(HOUR_START + 180, {'a.py': makeFileInfo(HOUR_START + 180, 1, 10, 100)}),
+        ]
+        rollups = R.rollupPayloads(payloads)
+        # in the order their first payload came in
+        self.assertEqual([R.getRollupKey(rollup) for rollup in rollups], [
+            ('/test/app', HOUR_START // 3600),
+            ('/test/app', HOUR_START // 3600 + 1),
+            ('/test/other', HOUR_START // 3600),
+        ])
+        self.assertEqual(rollups[0]['source']['a.py']['add'], 2)
+        self.assertEqual(rollups[0]['source']['a.py']['end'], HOUR_START + 240)
+
+    def test_payload_lines(self):
+        R = getModule('SoftwareRollup')
+        self.assertTrue(R.isPayloadLine(b'{"start": 1}\n'))
+        self.assertFalse(R.isPayloadLine(b'{"start": 1'))
+        self.assertFalse(R.isPayloadLine(b''))
+
+if __name__ == '__main__':
+    unittest.main()
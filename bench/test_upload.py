@@ -0,0 +1,287 @@
+# Copyright (c) 2018 by Software.com
+#
+# Regression tests of the offline uploads: refused batches are split
+# until the refused payload is found, an upload resumes where the last
+# one failed, and the journal cursors keep their format.
+#
+#   python -m unittest discover -s bench -p 'test_*.py'
+#
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from testing import getModule
+
+# big enough that a few payloads fill a batch of BATCH_MIN_BYTES
+PAYLOAD_PAD = 'x' * 2000
+
+def makePayload(payloadId):
+    return {
+        'id': payloadId, 'keystrokes': 1, 'start': 1560000000 + payloadId * 60,
+        'project': {'directory': '/test/app', 'name': 'app'}, 'source': {}, 'pad': PAYLOAD_PAD,
+    }
+
+def makeLine(payloadId):
+    return json.dumps(makePayload(payloadId))
+
+def getLineId(line):
+    return json.loads(line.decode('utf-8'))['id']
+
+#
+# Stands in for the batch api, outcomeFor(ids) is the outcome of
+# a batch holding the payloads with these ids.
+#
+class FakeBatchApi():
+    def __init__(self, outcomeFor):
+        self.outcomeFor = outcomeFor
+        self.lock = threading.Lock()
+        self.requests = []
+        self.accepted = set()
+
+    def sendBatch(self, lines):
+        N = getModule('SoftwareNetwork')
+        ids = [getLineId(line) for line in lines]
+        outcome = self.outcomeFor(ids)
+        with self.lock:
+            self.requests.append(ids)
+            if (outcome == N.BATCH_ACCEPTED):
+                self.accepted.update(ids)
+        return outcome
+
+    def sentIds(self):
+        return [payloadId for ids in self.requests for payloadId in ids]
+
+def acceptAll(ids):
+    return getModule('SoftwareNetwork').BATCH_ACCEPTED
+
+def refuseIds(refusedIds):
+    N = getModule('SoftwareNetwork')
+    return lambda ids: N.BATCH_REFUSED if set(ids) & set(refusedIds) else N.BATCH_ACCEPTED
+
+def retryIds(failedIds):
+    N = getModule('SoftwareNetwork')
+    return lambda ids: N.BATCH_RETRY if set(ids) & set(failedIds) else N.BATCH_ACCEPTED
+
+class UploadBatchesTest(unittest.TestCase):
+    def setUp(self):
+        N = getModule('SoftwareNetwork')
+        self.batchSize = N.AdaptiveBatchSize(N.BATCH_MIN_BYTES, N.BATCH_MIN_BYTES)
+        self.acked = []
+
+    def upload(self, api, items):
+        N = getModule('SoftwareNetwork')
+        batches = N.iterBatches(items, self.batchSize)
+        return N.uploadBatches(N.PAYLOADS_API, batches, api.sendBatch, self.acked.extend)
+
+    def makeItems(self, count):
+        return [(i, makeLine(i).encode('utf-8')) for i in range(count)]
+
+    def test_drops_only_the_refused_payload(self):
+        api = FakeBatchApi(refuseIds([37]))
+        self.assertTrue(self.upload(api, self.makeItems(100)))
+        self.assertEqual(sorted(self.acked), list(range(100)))
+        self.assertEqual(api.accepted, set(range(100)) - set([37]))
+
+    def test_keeps_everything_when_every_batch_is_refused(self):
+        N = getModule('SoftwareNetwork')
+        api = FakeBatchApi(lambda ids: N.BATCH_REFUSED)
+        self.assertFalse(self.upload(api, self.makeItems(100)))
+        self.assertEqual(self.acked, [])
+        # the first batches and the halves of the first one
+        self.assertEqual(len(api.requests), N.getEndpointConcurrency(N.PAYLOADS_API) + 2)
+
+    def test_stops_at_the_first_failure(self):
+        N = getModule('SoftwareNetwork')
+        api = FakeBatchApi(lambda ids: N.BATCH_RETRY)
+        self.assertFalse(self.upload(api, self.makeItems(100)))
+        self.assertEqual(self.acked, [])
+        self.assertLessEqual(len(api.requests), N.getEndpointConcurrency(N.PAYLOADS_API))
+
+    def test_limits_the_split_requests(self):
+        N = getModule('SoftwareNetwork')
+        refusedIds = set(range(20, 200, 3))
+        api = FakeBatchApi(refuseIds(refusedIds))
+        self.assertFalse(self.upload(api, self.makeItems(200)))
+        batchCount = len(list(N.iterBatches(self.makeItems(200), self.batchSize)))
+        self.assertLessEqual(len(api.requests), batchCount + N.MAX_SPLIT_REQUESTS)
+        # only the payloads refused on their own are dropped
+        self.assertTrue(set(self.acked) - api.accepted <= refusedIds)
+        self.assertEqual(len(self.acked), len(set(self.acked)))
+
+    def test_acknowledges_the_items_without_lines_with_their_batch(self):
+        items = self.makeItems(20)
+        items = [(token, None if token % 4 == 0 else line) for token, line in items] + [('end', None)]
+        api = FakeBatchApi(acceptAll)
+        self.assertTrue(self.upload(api, items))
+        self.assertEqual(sorted(self.acked, key=str), sorted([token for token, line in items], key=str))
+        self.assertEqual(sorted(api.sentIds()), [i for i in range(20) if i % 4 != 0])
+
+    def test_split_batch_halves_the_lines(self):
+        N = getModule('SoftwareNetwork')
+        batch = [(0, None), (1, b'a'), (2, b'b'), (3, None), (4, b'c'), (5, b'd')]
+        first, second = N.splitBatch(batch)
+        self.assertEqual(N.getBatchLines(first), [b'a', b'b'])
+        self.assertEqual(N.getBatchLines(second), [b'c', b'd'])
+        self.assertEqual(first + second, batch)
+
+class CursorTest(unittest.TestCase):
+    def test_add_range_merges_the_ranges(self):
+        J = getModule('SoftwareJournal')
+        ranges = J.addRange([], 10, 20)
+        ranges = J.addRange(ranges, 0, 5)
+        self.assertEqual(ranges, [[0, 5], [10, 20]])
+        self.assertEqual(J.addRange(ranges, 5, 10), [[0, 20]])
+        self.assertEqual(J.addRange(ranges, 15, 30), [[0, 5], [10, 30]])
+        self.assertEqual(J.addRange(ranges, 7, 7), ranges)
+
+    def test_is_range_acked(self):
+        J = getModule('SoftwareJournal')
+        ranges = [[0, 5], [10, 20]]
+        self.assertTrue(J.isRangeAcked(ranges, 0, 5))
+        self.assertTrue(J.isRangeAcked(ranges, 12, 20))
+        self.assertFalse(J.isRangeAcked(ranges, 4, 11))
+        self.assertFalse(J.isRangeAcked(ranges, 20, 21))
+        self.assertTrue(J.isRangeAcked([], 3, 3))
+
+    def test_acked_prefix(self):
+        J = getModule('SoftwareJournal')
+        self.assertEqual(J.getAckedPrefix([[0, 5], [10, 20]]), 5)
+        self.assertEqual(J.getAckedPrefix([[10, 20]]), 0)
+        self.assertEqual(J.getAckedPrefix([]), 0)
+
+    def test_reads_the_cursors_of_older_versions(self):
+        J = getModule('SoftwareJournal')
+        journal = J.OfflineJournal()
+        journal.journalDir = tempfile.mkdtemp(prefix='codetime-journal-')
+        self.addCleanup(shutil.rmtree, journal.journalDir, True)
+        with open(journal.cursorFile(1), 'w') as f:
+            f.write('120')
+        self.assertEqual(journal.readCursor(1), [[0, 120]])
+        journal.writeCursor(1, [[0, 40], [80, 120]])
+        self.assertEqual(journal.readCursor(1), [[0, 40], [80, 120]])
+        with open(journal.cursorFile(1), 'w') as f:
+            f.write('0')
+        self.assertEqual(journal.readCursor(1), [])
+        self.assertEqual(journal.readCursor(2), [])
+
+class JournalUploadTest(unittest.TestCase):
+    def setUp(self):
+        N = getModule('SoftwareNetwork')
+        J = getModule('SoftwareJournal')
+        self.journal = J.OfflineJournal()
+        self.journal.journalDir = tempfile.mkdtemp(prefix='codetime-journal-')
+        self.addCleanup(shutil.rmtree, self.journal.journalDir, True)
+        batchBytes = N.payloadBatchSize.batchBytes
+        N.payloadBatchSize.batchBytes = N.BATCH_MIN_BYTES
+        self.addCleanup(setattr, N.payloadBatchSize, 'batchBytes', batchBytes)
+
+    def appendPayloads(self, count, compress=False):
+        for i in range(0, count, 10):
+            self.journal.append([makeLine(payloadId) for payloadId in range(i, min(i + 10, count))])
+        self.journal.seal()
+        if (compress):
+            J = getModule('SoftwareJournal')
+            idleTime = time.time() - J.COMPRESS_IDLE_SEC - 60
+            for seq in self.journal.listSegments():
+                os.utime(self.journal.segmentFile(seq), (idleTime, idleTime))
+            self.journal.seal()
+            self.assertTrue(all(os.path.exists(self.journal.compressedFile(seq)) for seq in self.journal.listSegments()))
+
+    def checkResume(self, compress):
+        self.appendPayloads(60, compress)
+        seq = self.journal.listSegments()[0]
+
+        failedApi = FakeBatchApi(retryIds([30]))
+        self.assertFalse(self.journal.upload(failedApi.sendBatch))
+        self.assertNotIn(30, failedApi.accepted)
+        ranges = self.journal.readCursor(seq)
+        self.assertTrue(ranges)
+        self.assertTrue(all(isinstance(r, list) and len(r) == 2 and r[0] < r[1] for r in ranges))
+
+        api = FakeBatchApi(acceptAll)
+        self.assertTrue(self.journal.upload(api.sendBatch))
+        # only what wasn't accepted before is sent again
+        self.assertEqual(sorted(api.sentIds()), sorted(set(range(60)) - failedApi.accepted))
+        self.assertEqual(self.journal.listSegments(), [])
+        self.assertFalse(os.path.exists(self.journal.cursorFile(seq)))
+
+    def test_resumes_after_a_failure(self):
+        self.checkResume(False)
+
+    def test_resumes_a_compressed_segment_after_a_failure(self):
+        self.checkResume(True)
+
+    def test_resumes_from_an_older_cursor(self):
+        self.appendPayloads(20)
+        seq = self.journal.listSegments()[0]
+        offset = sum(len(makeLine(payloadId)) + 1 for payloadId in range(5))
+        with open(self.journal.cursorFile(seq), 'w') as f:
+            f.write(str(offset))
+
+        api = FakeBatchApi(acceptAll)
+        self.assertTrue(self.journal.upload(api.sendBatch))
+        self.assertEqual(sorted(api.sentIds()), list(range(5, 20)))
+
+    def test_drops_only_the_refused_payload(self):
+        self.appendPayloads(60)
+        api = FakeBatchApi(refuseIds([44]))
+        self.assertTrue(self.journal.upload(api.sendBatch))
+        self.assertEqual(api.accepted, set(range(60)) - set([44]))
+        self.assertEqual(self.journal.listSegments(), [])
+
+    def test_keeps_everything_when_every_batch_is_refused(self):
+        N = getModule('SoftwareNetwork')
+        self.appendPayloads(60)
+        api = FakeBatchApi(lambda ids: N.BATCH_REFUSED)
+        self.assertFalse(self.journal.upload(api.sendBatch))
+
+        api = FakeBatchApi(acceptAll)
+        self.assertTrue(self.journal.upload(api.sendBatch))
+        self.assertEqual(sorted(api.sentIds()), list(range(60)))
+
+class StoreUploadTest(unittest.TestCase):
+    def setUp(self):
+        N = getModule('SoftwareNetwork')
+        S = getModule('SoftwareStore')
+        self.store = S.MetricsStore()
+        self.addCleanup(self.store.close)
+        self.store.write(None, lambda conn: conn.execute('DELETE FROM payloads'))
+        batchBytes = N.payloadBatchSize.batchBytes
+        N.payloadBatchSize.batchBytes = N.BATCH_MIN_BYTES
+        self.addCleanup(setattr, N.payloadBatchSize, 'batchBytes', batchBytes)
+
+    def appendPayloads(self, count):
+        payloads = [makePayload(payloadId) for payloadId in range(count)]
+        self.assertTrue(self.store.appendPayloads(payloads, [json.dumps(payload) for payload in payloads]))
+
+    def test_resumes_after_a_failure(self):
+        self.appendPayloads(40)
+        failedApi = FakeBatchApi(retryIds([20]))
+        self.assertFalse(self.store.upload(failedApi.sendBatch))
+        self.assertEqual(self.store.pendingPayloadCount(), 40 - len(failedApi.accepted))
+
+        api = FakeBatchApi(acceptAll)
+        self.assertTrue(self.store.upload(api.sendBatch))
+        self.assertEqual(sorted(api.sentIds()), sorted(set(range(40)) - failedApi.accepted))
+        self.assertEqual(self.store.pendingPayloadCount(), 0)
+
+    def test_drops_only_the_refused_payload(self):
+        self.appendPayloads(40)
+        api = FakeBatchApi(refuseIds([17]))
+        self.assertTrue(self.store.upload(api.sendBatch))
+        self.assertEqual(api.accepted, set(range(40)) - set([17]))
+        self.assertEqual(self.store.pendingPayloadCount(), 0)
+
+    def test_keeps_everything_when_every_batch_is_refused(self):
+        N = getModule('SoftwareNetwork')
+        self.appendPayloads(40)
+        api = FakeBatchApi(lambda ids: N.BATCH_REFUSED)
+        self.assertFalse(self.store.upload(api.sendBatch))
+        self.assertEqual(self.store.pendingPayloadCount(), 40)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+# Copyright (c) 2018 by Software.com
+#
+# Loads the plugin once for the regression tests, with the bench stubs
+# standing in for Sublime Text and a throwaway home directory.
+#
+#   python -m unittest discover -s bench -p 'test_*.py'
+#
+import atexit
+import shutil
+import sys
+import tempfile
+
+from bench_events import PACKAGE_NAME, loadPlugin
+
+def getPlugin():
+    plugin = sys.modules.get(PACKAGE_NAME + '.Software')
+    if (plugin is None):
+        homeDir = tempfile.mkdtemp(prefix='codetime-test-')
+        atexit.register(shutil.rmtree, homeDir, True)
+        plugin = loadPlugin(homeDir)
+        atexit.register(plugin.plugin_unloaded)
+    return plugin
+
+# a module of lib/, e.g. getModule('SoftwareJournal')
+def getModule(name):
+    getPlugin()
+    return sys.modules[PACKAGE_NAME + '.lib.' + name]
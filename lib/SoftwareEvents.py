@@ -0,0 +1,109 @@
+# Copyright (c) 2018 by Software.com
+from threading import Thread, Event
+from collections import deque
+from .SoftwareUtil import *
+
+# editor event kinds captured by the listener
+CALL_EVENT = 0
+OPEN_EVENT = 1
+CLOSE_EVENT = 2
+MODIFIED_EVENT = 3
+
+EVENT_BUFFER_CAPACITY = 8192
+EVENT_BATCH_SIZE = 256
+
+#
+# Bounded buffer of captured editor events. deque append and popleft are
+# atomic, so the editor threads never wait on the aggregator to push.
+#
+class EventRingBuffer():
+    def __init__(self, capacity):
+        self.events = deque()
+        self.capacity = capacity
+        self.ready = Event()
+        self.dropped = 0
+
+    def push(self, event):
+        if (len(self.events) >= self.capacity):
+            # the aggregator is too far behind, drop the new event
+            self.dropped += 1
+            return
+        self.append(event)
+
+    # append without the capacity check, used for aggregator calls
+    def append(self, event):
+        self.events.append(event)
+        if (not self.ready.is_set()):
+            self.ready.set()
+
+    def drain(self, maxCount):
+        batch = []
+        popleft = self.events.popleft
+        try:
+            while (len(batch) < maxCount):
+                batch.append(popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def __len__(self):
+        return len(self.events)
+
+#
+# Single thread draining the ring buffer in batches. Anything else that
+# mutates the aggregated data (flushes, focus changes) is handed to it
+# through call() so recording and flushing never run at the same time.
+#
+class EventAggregator():
+    def __init__(self, handler, capacity=EVENT_BUFFER_CAPACITY, batchSize=EVENT_BATCH_SIZE):
+        self.handler = handler
+        self.batchSize = batchSize
+        self.buffer = EventRingBuffer(capacity)
+        self.running = True
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def push(self, event):
+        self.buffer.push(event)
+
+    # run func on the aggregator thread, after the events captured so far
+    def call(self, func, *args):
+        self.buffer.append((CALL_EVENT, func, args))
+
+    def stop(self):
+        self.running = False
+        self.buffer.ready.set()
+        self.thread.join(5)
+
+    def worker(self):
+        while self.running:
+            self.buffer.ready.wait()
+            self.buffer.ready.clear()
+            self.process()
+        # drain whatever was captured before the stop
+        self.process()
+
+    def process(self):
+        while (len(self.buffer) > 0):
+            batch = self.buffer.drain(self.batchSize)
+            events = []
+            for event in batch:
+                if (event[0] != CALL_EVENT):
+                    events.append(event)
+                    continue
+
+                # aggregate the events captured before the call first
+                self.handle(events)
+                events = []
+                try:
+                    event[1](*event[2])
+                except Exception as ex:
+                    log("Code Time: Unable to run aggregator task: %s" % ex)
+            self.handle(events)
+
+    def handle(self, events):
+        if (events):
+            try:
+                self.handler(events)
+            except Exception as ex:
+                log("Code Time: Unable to aggregate editor events: %s" % ex)
@@ -0,0 +1,235 @@
+# Copyright (c) 2018 by Software.com
+import os
+import re
+import zlib
+
+#
+# Reads the repo metadata straight from the git files so
+# getResourceInfo doesn't need to spawn git processes.
+#
+
+CONFIG_SECTION_RE = re.compile(r'^\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+
+# find the .git directory of the repo containing rootDir
+def getGitDir(rootDir):
+    currentDir = os.path.abspath(rootDir)
+    while True:
+        gitPath = os.path.join(currentDir, '.git')
+        if (os.path.isdir(gitPath)):
+            return gitPath
+        if (os.path.isfile(gitPath)):
+            # worktrees and submodules point to their git dir
+            line = readFirstLine(gitPath)
+            if (line is not None and line.startswith('gitdir:')):
+                return os.path.normpath(os.path.join(currentDir, line[len('gitdir:'):].strip()))
+            return None
+        parentDir = os.path.dirname(currentDir)
+        if (parentDir == currentDir):
+            return None
+        currentDir = parentDir
+
+# the shared git dir holding the config and refs of a worktree
+def getCommonGitDir(gitDir):
+    line = readFirstLine(os.path.join(gitDir, 'commondir'))
+    if (line):
+        return os.path.normpath(os.path.join(gitDir, line))
+    return gitDir
+
+def readFirstLine(file):
+    try:
+        with open(file, encoding='utf-8') as f:
+            return f.readline().strip()
+    except Exception:
+        return None
+
+# parse a git config file into {"section.subsection.key": value}
+def readGitConfig(file, config=None, depth=0):
+    if (config is None):
+        config = {}
+    try:
+        with open(file, encoding='utf-8') as f:
+            lines = f.readlines()
+    except Exception:
+        return config
+
+    section = None
+    for line in lines:
+        line = line.strip()
+        if (not line or line[0] in '#;'):
+            continue
+
+        match = CONFIG_SECTION_RE.match(line)
+        if (match):
+            section = match.group(1).lower()
+            if (match.group(2) is not None):
+                section += '.' + match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+            line = line[match.end():].strip()
+            if (not line):
+                continue
+
+        if (section is None):
+            continue
+
+        key, sep, value = line.partition('=')
+        key = key.strip().lower()
+        value = parseConfigValue(value) if sep else 'true'
+
+        if (section == 'include' and key == 'path' and depth < 5):
+            readGitConfig(resolveConfigPath(file, value), config, depth + 1)
+            continue
+        config[section + '.' + key] = value
+    return config
+
+def parseConfigValue(value):
+    value = value.strip()
+    # strip trailing comments outside of quotes
+    result = ''
+    inQuote = False
+    i = 0
+    while (i < len(value)):
+        c = value[i]
+        if (c == '\\' and i + 1 < len(value)):
+            result += {'n': '\n', 't': '\t'}.get(value[i + 1], value[i + 1])
+            i += 2
+            continue
+        if (c == '"'):
+            inQuote = not inQuote
+        elif (c in '#;' and not inQuote):
+            break
+        else:
+            result += c
+        i += 1
+    return result.strip()
+
+def resolveConfigPath(configFile, path):
+    path = os.path.expanduser(path)
+    if (not os.path.isabs(path)):
+        path = os.path.join(os.path.dirname(configFile), path)
+    return path
+
+# the config files git reads, from lowest to highest priority
+def getGitConfigFiles(commonDir):
+    files = []
+    xdgHome = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    files.append(os.path.join(xdgHome, 'git', 'config'))
+    files.append(os.path.join(os.path.expanduser('~'), '.gitconfig'))
+    files.append(os.path.join(commonDir, 'config'))
+    return files
+
+def readMergedGitConfig(commonDir):
+    config = {}
+    for file in getGitConfigFiles(commonDir):
+        if (os.path.isfile(file)):
+            readGitConfig(file, config)
+    return config
+
+# {"refs/tags/v1": sha} from packed-refs and the loose refs of the prefix,
+# annotated tags are peeled to their commit and added to the annotated set
+def readRefs(commonDir, prefix, annotated=None):
+    refs = {}
+    if (annotated is None):
+        annotated = set()
+    packedRefs = os.path.join(commonDir, 'packed-refs')
+    try:
+        with open(packedRefs, encoding='utf-8') as f:
+            lastTag = None
+            for line in f:
+                line = line.strip()
+                if (not line or line[0] == '#'):
+                    continue
+                if (line[0] == '^'):
+                    # peeled annotated tag, the commit it points to
+                    if (lastTag is not None):
+                        refs[lastTag] = line[1:]
+                        annotated.add(lastTag)
+                    continue
+                sha, sep, ref = line.partition(' ')
+                lastTag = None
+                if (ref.startswith(prefix)):
+                    refs[ref] = sha
+                    lastTag = ref
+    except Exception:
+        pass
+
+    refsDir = os.path.join(commonDir, prefix)
+    for dirPath, dirNames, fileNames in os.walk(refsDir):
+        for fileName in fileNames:
+            file = os.path.join(dirPath, fileName)
+            ref = os.path.relpath(file, commonDir).replace(os.sep, '/')
+            sha = readFirstLine(file)
+            if (sha):
+                peeledSha = peelTag(commonDir, sha)
+                if (peeledSha != sha):
+                    annotated.add(ref)
+                else:
+                    annotated.discard(ref)
+                refs[ref] = peeledSha
+    return refs
+
+# the commit an annotated tag object points to, loose objects only
+def peelTag(commonDir, sha):
+    objectFile = os.path.join(commonDir, 'objects', sha[:2], sha[2:])
+    try:
+        with open(objectFile, 'rb') as f:
+            data = zlib.decompressobj().decompress(f.read(), 256)
+        if (data.startswith(b'tag ')):
+            body = data[data.index(b'\0') + 1:]
+            if (body.startswith(b'object ')):
+                return body[len('object '):len('object ') + 40].decode('ascii')
+    except Exception:
+        pass
+    return sha
+
+# the branch name or None if HEAD is detached, and the HEAD commit
+def readHead(gitDir, commonDir):
+    head = readFirstLine(os.path.join(gitDir, 'HEAD'))
+    if (not head):
+        return (None, None)
+    if (head.startswith('ref:')):
+        ref = head[len('ref:'):].strip()
+        sha = readFirstLine(os.path.join(commonDir, ref))
+        if (not sha):
+            sha = readRefs(commonDir, ref).get(ref)
+        branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        return (branch, sha)
+    return (None, head)
+
+# the closest of "git describe --all" we can give without walking
+# history: an exact tag (annotated first), else the current branch
+def describeHead(commonDir, branch, sha):
+    if (sha):
+        annotated = set()
+        refs = readRefs(commonDir, 'refs/tags/', annotated)
+        tags = sorted((ref not in annotated, ref) for ref, tagSha in refs.items() if tagSha == sha)
+        if (tags):
+            return tags[0][1][len('refs/'):]
+    if (branch):
+        return 'heads/' + branch
+    return None
+
+# read the repo info without running git. Returns (resource info, True
+# if git has to be asked for the email), None when there are no repo
+# files to read and git needs to be asked for all of it.
+def readResourceInfo(rootDir):
+    gitDir = getGitDir(rootDir)
+    if (gitDir is None or not os.path.isdir(gitDir)):
+        return None
+
+    commonDir = getCommonGitDir(gitDir)
+    config = readMergedGitConfig(commonDir)
+    branch, sha = readHead(gitDir, commonDir)
+
+    resourceInfo = {}
+    identifier = config.get('remote.origin.url')
+    if (identifier):
+        resourceInfo['identifier'] = identifier
+    if (branch):
+        resourceInfo['branch'] = branch
+    tag = describeHead(commonDir, branch, sha)
+    if (tag):
+        resourceInfo['tag'] = tag
+    email = config.get('user.email')
+    if (email):
+        resourceInfo['email'] = email
+    # conditional includes may set the email, only git evaluates them
+    return (resourceInfo, not email and any(key.startswith('includeif.') for key in config))
@@ -1,12 +1,47 @@
 
 # Copyright (c) 2018 by Software.com
 
-import http
+import http.client
+import gzip
 import json
+import random
+import ssl
+import threading
+import time
+from collections import deque
 import sublime_plugin, sublime
 from .SoftwareSettings import *
 
 USER_AGENT = 'Code Time Sublime Plugin'
+# smaller bodies aren't worth compressing
+GZIP_MIN_BYTES = 1024
+# connections open at once per api host
+POOL_MAX_CONNECTIONS = 4
+# idle connections older than this are closed instead of reused,
+# servers commonly drop keep-alive sockets after a minute
+POOL_IDLE_SEC = 30
+# (connect, read) timeouts in seconds by api path, the longest
+# matching prefix wins
+REQUEST_TIMEOUTS = {
+    "/ping": (3, 5),
+    "/data/batch": (5, 60),
+    "/dashboard": (5, 30),
+    "/sessions": (5, 30),
+}
+DEFAULT_REQUEST_TIMEOUT = (5, 15)
+# retries of a failed idempotent request, with a random delay of up to
+# the base delay doubled per attempt and capped
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+RETRY_ATTEMPTS = 2
+RETRY_BASE_DELAY_SEC = 0.5
+RETRY_MAX_DELAY_SEC = 4
+# consecutive failures opening the circuit and the cool-down before a
+# probe, doubled after each failed probe
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_COOLDOWN_SEC = 30
+BREAKER_MAX_COOLDOWN_SEC = 60 * 5
+# an api answer within this many seconds makes a ping unnecessary
+HEALTH_TTL_SEC = 60
 lastMsg = None
 windowView = None
 
@@ -58,8 +93,282 @@ def isUnauthenticated(response):
         return True
     return False
 
-# send the request.
-def requestIt(method, api, payload, jwt):
+# the response of a pooled request, its body is read before the
+# connection goes back to the pool
+class BufferedResponse():
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.getheaders()
+        self.body = response.read()
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        for key, value in self.headers:
+            if (key.lower() == name.lower()):
+                return value
+        return default
+
+    def getheaders(self):
+        return self.headers
+
+# an https connection resuming the last tls session of its pool
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, pool):
+        http.client.HTTPSConnection.__init__(self, host, context=pool.sslContext)
+        self.pool = pool
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        if (self._tunnel_host):
+            serverHostname = self._tunnel_host
+        else:
+            serverHostname = self.host
+        if (self.pool.tlsSession is not None and getattr(ssl.SSLSocket, "session", None) is not None):
+            self.sock = self.pool.sslContext.wrap_socket(self.sock, server_hostname=serverHostname,
+                session=self.pool.tlsSession)
+        else:
+            self.sock = self.pool.sslContext.wrap_socket(self.sock, server_hostname=serverHostname)
+        # python 3.3 contexts don't check the host name themselves
+        if (not getattr(self.pool.sslContext, "check_hostname", False)):
+            ssl.match_hostname(self.sock.getpeercert(), serverHostname)
+        self.pool.tlsSession = getattr(self.sock, "session", None)
+
+#
+# Short-circuits requests to an api host after repeated failures. Once
+# the cool-down is over, one probe request is let through; its success
+# closes the circuit, its failure opens it again for longer. The
+# "online" setting follows the circuit.
+#
+class CircuitBreaker():
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN_SEC
+        self.openedAt = 0
+        self.probing = False
+        self.lastSuccessAt = None
+
+    # False if the request should be skipped
+    def allowRequest(self):
+        with self.lock:
+            if (self.state == CircuitBreaker.CLOSED):
+                return True
+            if (self.state == CircuitBreaker.OPEN):
+                if (time.monotonic() - self.openedAt < self.cooldown):
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+            # only one probe at a time
+            if (self.probing):
+                return False
+            self.probing = True
+            return True
+
+    def recordSuccess(self):
+        with self.lock:
+            wasClosed = (self.state == CircuitBreaker.CLOSED)
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.cooldown = BREAKER_COOLDOWN_SEC
+            self.probing = False
+            self.lastSuccessAt = time.monotonic()
+        if (not wasClosed):
+            httpLog("Code Time: api available again")
+            setValue("online", True)
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == CircuitBreaker.HALF_OPEN):
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN_SEC)
+            elif (self.state == CircuitBreaker.OPEN or self.failures < BREAKER_FAILURE_THRESHOLD):
+                return
+            wasClosed = (self.state == CircuitBreaker.CLOSED)
+            self.state = CircuitBreaker.OPEN
+            self.openedAt = time.monotonic()
+            self.probing = False
+            cooldown = self.cooldown
+        httpLog("Code Time: api unavailable, pausing requests for %d seconds" % cooldown)
+        if (wasClosed):
+            setValue("online", False)
+
+    # the probe let through never reached the api, the next request
+    # may probe instead
+    def releaseProbe(self):
+        with self.lock:
+            if (self.state == CircuitBreaker.HALF_OPEN and self.probing):
+                self.state = CircuitBreaker.OPEN
+                self.probing = False
+
+    def isOpen(self):
+        with self.lock:
+            return (self.state != CircuitBreaker.CLOSED)
+
+    # the api's health as known from the recent requests, None if a
+    # ping is needed to tell. busy is True while requests are in flight,
+    # their outcome will update the last known health.
+    def getHealth(self, ttl, busy):
+        with self.lock:
+            if (self.state == CircuitBreaker.OPEN):
+                if (time.monotonic() - self.openedAt < self.cooldown):
+                    return False
+                return None
+            if (self.state == CircuitBreaker.CLOSED and self.lastSuccessAt is not None):
+                if (busy or time.monotonic() - self.lastSuccessAt < ttl):
+                    return True
+            return None
+
+# every pooled connection stayed busy for as long as the request could wait
+class PoolTimeoutError(Exception):
+    pass
+
+# keep-alive connections to one api host, shared by the plugin threads
+class ConnectionPool():
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.secure = 'localhost' not in endpoint
+        self.idle = deque()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+        self.sslContext = None
+        self.tlsSession = None
+        self.breaker = CircuitBreaker()
+        if (self.secure):
+            self.sslContext = createSslContext()
+
+    # reuse the most recent idle connection, or open a new one. Waits at
+    # most timeout seconds for a connection to be free.
+    def checkout(self, timeout):
+        if (not self.slots.acquire(timeout=timeout)):
+            raise PoolTimeoutError("no free connection to %s" % self.endpoint)
+        now = time.time()
+        with self.lock:
+            self.active += 1
+            while (len(self.idle) > 0):
+                connection, idleSince = self.idle.pop()
+                if (now - idleSince < POOL_IDLE_SEC):
+                    return connection, True
+                connection.close()
+        try:
+            if (self.secure):
+                return PooledHTTPSConnection(self.endpoint, self), False
+            return http.client.HTTPConnection(self.endpoint), False
+        except Exception:
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+            raise
+
+    def checkin(self, connection, reusable):
+        with self.lock:
+            self.active -= 1
+            if (reusable):
+                self.idle.append((connection, time.time()))
+        if (not reusable):
+            connection.close()
+        self.slots.release()
+
+    def isBusy(self):
+        with self.lock:
+            return (self.active > 0)
+
+    def close(self):
+        with self.lock:
+            while (len(self.idle) > 0):
+                connection, idleSince = self.idle.pop()
+                connection.close()
+
+pools = {}
+poolsLock = threading.Lock()
+
+def createSslContext():
+    if (getattr(ssl, "create_default_context", None) is not None):
+        return ssl.create_default_context()
+    # python 3.3
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2
+    context.options |= ssl.OP_NO_SSLv3
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.set_default_verify_paths()
+    return context
+
+def getConnectionPool(endpoint):
+    with poolsLock:
+        pool = pools.get(endpoint)
+        if (pool is None):
+            pool = ConnectionPool(endpoint)
+            pools[endpoint] = pool
+        return pool
+
+# False while requests to the api are short-circuited
+def isApiAvailable():
+    endpoint = getValue("software_api_endpoint", "api.software.com")
+    return (not getConnectionPool(endpoint).breaker.isOpen())
+
+# True or False if the recent requests tell whether the api is
+# reachable, None if it takes a ping to know
+def getApiHealth():
+    endpoint = getValue("software_api_endpoint", "api.software.com")
+    pool = getConnectionPool(endpoint)
+    return pool.breaker.getHealth(HEALTH_TTL_SEC, pool.isBusy())
+
+def getRequestTimeouts(api):
+    path = api.split("?")[0]
+    timeouts = DEFAULT_REQUEST_TIMEOUT
+    matched = ""
+    for prefix in REQUEST_TIMEOUTS:
+        if (path.startswith(prefix) and len(prefix) > len(matched)):
+            timeouts = REQUEST_TIMEOUTS[prefix]
+            matched = prefix
+    return timeouts
+
+def getRetryDelay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY_SEC, RETRY_BASE_DELAY_SEC * (2 ** attempt)))
+
+# close the idle connections, e.g. when the plugin unloads
+def closeConnections():
+    with poolsLock:
+        for pool in pools.values():
+            pool.close()
+
+# send the request over a pooled connection, a reused connection the
+# server has already closed is retried once on a fresh one
+def sendRequest(pool, method, api, payload, headers, timeouts):
+    connectTimeout, readTimeout = timeouts
+    while True:
+        connection, reused = pool.checkout(connectTimeout)
+        try:
+            if (connection.sock is None):
+                connection.timeout = connectTimeout
+                connection.connect()
+            connection.sock.settimeout(readTimeout)
+            connection.request(method, api, payload, headers)
+            response = connection.getresponse()
+            bufferedResponse = BufferedResponse(response)
+        except (http.client.BadStatusLine, ConnectionError) as ex:
+            pool.checkin(connection, False)
+            if (reused):
+                continue
+            raise
+        except Exception:
+            pool.checkin(connection, False)
+            raise
+        pool.checkin(connection, not response.will_close)
+        return bufferedResponse
+
+# send the request, the payload is a json string or utf-8 encoded
+# json, compress gzips it. Failed idempotent requests are retried
+# with backoff, None if the request failed or was skipped while the
+# api is unavailable.
+def requestIt(method, api, payload, jwt, compress=False):
 
     api_endpoint = getValue("software_api_endpoint", "api.software.com")
     telemetry = getValue("software_telemetry_on", True)
@@ -70,13 +379,6 @@ def requestIt(method, api, payload, jwt):
 
     # try to update kpm data.
     try:
-        connection = None
-        # create the connection
-        if ('localhost' in api_endpoint):
-            connection = http.client.HTTPConnection(api_endpoint)
-        else:
-            connection = http.client.HTTPSConnection(api_endpoint)
-
         headers = {'Content-Type': 'application/json', 'User-Agent': USER_AGENT}
             
         if (jwt is not None):
@@ -85,21 +387,50 @@ def requestIt(method, api, payload, jwt):
             httpLog("Code Time: no auth token available to post kpm data: %s" % payload)
             return None
 
-        # make the request
+        # requests without a payload are sent without a body
         if (payload is None):
-            payload = {}
             httpLog("Code Time: Requesting [" + method + ": " + api_endpoint + "" + api + "]")
         else:
             httpLog("Code Time: Sending [" + method + ": " + api_endpoint + "" + api + ", headers: " + json.dumps(headers) + "] payload: %s" % payload)
-        
 
-        # send the request
-        connection.request(method, api, payload, headers)
+            if (isinstance(payload, str)):
+                payload = payload.encode('utf-8')
+            if (compress is True and len(payload) >= GZIP_MIN_BYTES):
+                payload = gzip.compress(payload)
+                headers['Content-Encoding'] = 'gzip'
 
-        response = connection.getresponse()
-        # httpLog("Code Time: " + api_endpoint + "" + api + " Response (%d)" % response.status)
-        return response
+        pool = getConnectionPool(api_endpoint)
+        timeouts = getRequestTimeouts(api)
     except Exception as ex:
         print("Code Time: " + api + " Network error: %s" % ex)
         return None
 
+    attempt = 0
+    while True:
+        if (not pool.breaker.allowRequest()):
+            httpLog("Code Time: " + api + " skipped, the api is unavailable")
+            return None
+
+        # send the request
+        response = None
+        try:
+            response = sendRequest(pool, method, api, payload, headers, timeouts)
+        except PoolTimeoutError as ex:
+            # the plugin's own requests are taking every connection, the
+            # api isn't failing
+            print("Code Time: " + api + " Network error: %s" % ex)
+            pool.breaker.releaseProbe()
+            return None
+        except Exception as ex:
+            print("Code Time: " + api + " Network error: %s" % ex)
+
+        # httpLog("Code Time: " + api_endpoint + "" + api + " Response (%d)" % response.status)
+        if (response is not None and int(response.status) < 500):
+            pool.breaker.recordSuccess()
+            return response
+        pool.breaker.recordFailure()
+
+        if (method not in IDEMPOTENT_METHODS or attempt >= RETRY_ATTEMPTS):
+            return response
+        time.sleep(getRetryDelay(attempt))
+        attempt += 1
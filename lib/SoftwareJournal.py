@@ -0,0 +1,638 @@
+# Copyright (c) 2018 by Software.com
+from threading import Lock
+from array import array
+import bisect
+import json
+import mmap
+import os
+import re
+import time
+import zlib
+from .SoftwareUtil import *
+from .SoftwareScheduler import *
+from .SoftwareLock import *
+from .SoftwareRollup import *
+from .SoftwareNetwork import *
+
+# the active segment gets sealed once it's bigger than this
+SEGMENT_MAX_BYTES = 256 * 1024
+# appends are fsynced at most this often
+FSYNC_INTERVAL_SEC = 30
+
+# read size when streaming a compressed segment
+COMPRESSED_READ_BYTES = 64 * 1024
+# sealed segments are only compressed once they've waited this long to be
+# uploaded, the ones uploaded right away are read through a memory map
+COMPRESS_IDLE_SEC = 2 * 60 * 60
+
+SEGMENT_FILE_RE = re.compile(r'^segment-(\d+)\.log(\.z)?$')
+
+def getJournalDir():
+    journalDir = os.path.join(getSoftwareDir(True), 'journal')
+    os.makedirs(journalDir, exist_ok=True)
+    return journalDir
+
+# write a small file so it's either the old or the new content after a crash
+def writeFileDurably(file, content):
+    tmpFile = file + '.tmp'
+    with open(tmpFile, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpFile, file)
+
+#
+# Append-only journal of the kpm payloads waiting to be uploaded.
+#
+# Payloads are appended as json lines to the active segment. Uploads only
+# read sealed segments, each with a durable cursor of the byte ranges the
+# server acknowledged, and a segment is only deleted once all of it was acked.
+#
+class OfflineJournal():
+    def __init__(self):
+        self.lock = Lock()
+        self.uploadLock = Lock()
+        self.journalDir = None
+        self.activeSeq = None
+        self.activeFile = None
+        self.activeSize = 0
+        # held while the segment is active, so other instances leave it alone
+        self.activeLock = None
+        self.lastFsync = 0
+        self.fsyncJob = None
+
+    def getDir(self):
+        if (self.journalDir is None):
+            self.journalDir = getJournalDir()
+            self.importDataStoreFile()
+        return self.journalDir
+
+    def segmentFile(self, seq):
+        return os.path.join(self.getDir(), 'segment-%012d.log' % seq)
+
+    # a sealed segment once it's been compressed
+    def compressedFile(self, seq):
+        return self.segmentFile(seq) + '.z'
+
+    def cursorFile(self, seq):
+        return os.path.join(self.getDir(), 'segment-%012d.cursor' % seq)
+
+    # sequence numbers of the segments on disk, oldest first
+    def listSegments(self):
+        seqs = set()
+        for name in os.listdir(self.getDir()):
+            match = SEGMENT_FILE_RE.match(name)
+            if (match):
+                seqs.add(int(match.group(1)))
+        return sorted(seqs)
+
+    # a data.json left by an older version becomes a segment
+    def importDataStoreFile(self):
+        dataStoreFile = getSoftwareDataStoreFile()
+        if (not os.path.exists(dataStoreFile)):
+            return
+        try:
+            with FileLock(dataStoreFile):
+                if (not os.path.exists(dataStoreFile)):
+                    # another instance imported it
+                    return
+                seq, segmentLock, segmentFileObj = self.createSegment()
+                segmentFileObj.close()
+                os.replace(dataStoreFile, self.segmentFile(seq))
+                segmentLock.release()
+        except Exception as ex:
+            log("Code Time: Unable to move the offline data file into the journal: %s" % ex)
+
+    # create the next segment, exclusively even when other editor instances
+    # share the journal. Returns (seq, held lock, file opened for writing).
+    def createSegment(self):
+        seqs = self.listSegments()
+        seq = seqs[-1] + 1 if seqs else 1
+        while True:
+            segmentLock = FileLock(self.segmentFile(seq))
+            if (segmentLock.acquire(False)):
+                try:
+                    return (seq, segmentLock, open(self.segmentFile(seq), 'xb'))
+                except FileExistsError:
+                    segmentLock.release()
+            seq += 1
+
+    # append payload lines to the active segment
+    def append(self, lines):
+        content = ''.join(line + '\n' for line in lines)
+        data = content.encode('utf-8')
+        rotated = False
+        with self.lock:
+            if (self.activeFile is None or self.activeSize >= SEGMENT_MAX_BYTES):
+                rotated = self.activeFile is not None
+                self.openNextSegment()
+            self.activeFile.write(data)
+            self.activeFile.flush()
+            self.activeSize += len(data)
+            self.syncLater()
+
+        if (rotated):
+            self.compressSealedSegments()
+
+    # a new segment is opened for every run, so appends never
+    # land after a line torn by a crash
+    def openNextSegment(self):
+        self.closeActiveSegment()
+        self.activeSeq, self.activeLock, self.activeFile = self.createSegment()
+        self.activeSize = 0
+
+    def closeActiveSegment(self):
+        if (self.activeFile is None):
+            return
+        try:
+            self.activeFile.flush()
+            os.fsync(self.activeFile.fileno())
+            self.activeFile.close()
+        except Exception as ex:
+            log("Code Time: Unable to close the journal segment: %s" % ex)
+        self.activeLock.release()
+        self.activeLock = None
+        self.activeFile = None
+        self.activeSeq = None
+        self.activeSize = 0
+
+    # fsync now if it's been a while, otherwise make sure one is scheduled
+    def syncLater(self):
+        now = time.monotonic()
+        if (now - self.lastFsync >= FSYNC_INTERVAL_SEC):
+            self.sync()
+        elif (self.fsyncJob is None):
+            self.fsyncJob = runLater(FSYNC_INTERVAL_SEC, self.scheduledSync)
+
+    def scheduledSync(self):
+        with self.lock:
+            self.fsyncJob = None
+            self.sync()
+
+    def sync(self):
+        if (self.activeFile is not None):
+            os.fsync(self.activeFile.fileno())
+        self.lastFsync = time.monotonic()
+
+    # seal the active segment so its payloads can be uploaded
+    def seal(self):
+        with self.lock:
+            self.closeActiveSegment()
+        self.compressSealedSegments()
+
+    # zlib compress the idle sealed segments when enabled in the settings
+    def compressSealedSegments(self):
+        if (getValue("software_compress_offline_data", True) is not True):
+            return
+        idleTime = time.time() - COMPRESS_IDLE_SEC
+        with self.lock:
+            seqs = [seq for seq in self.listSegments() if seq != self.activeSeq]
+        for seq in seqs:
+            fileStat = getFileStat(self.segmentFile(seq))
+            if (fileStat is None or fileStat[0] > idleTime):
+                # already compressed, or likely uploaded soon
+                continue
+            segmentLock = FileLock(self.segmentFile(seq))
+            if (not segmentLock.acquire(False)):
+                # active in, or being uploaded by, another instance
+                continue
+            try:
+                if (os.path.exists(self.segmentFile(seq)) and not os.path.exists(self.compressedFile(seq))):
+                    self.compressSegment(seq)
+            except Exception as ex:
+                log("Code Time: Unable to compress the offline data: %s" % ex)
+            finally:
+                segmentLock.release()
+
+    def compressSegment(self, seq):
+        plainFile = self.segmentFile(seq)
+        compressedFile = self.compressedFile(seq)
+        tmpFile = compressedFile + '.tmp'
+        compressor = zlib.compressobj(6)
+        with open(plainFile, 'rb') as src, open(tmpFile, 'wb') as dst:
+            while True:
+                chunk = src.read(COMPRESSED_READ_BYTES)
+                if (not chunk):
+                    break
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+            dst.flush()
+            os.fsync(dst.fileno())
+        # keeps the segment's date, the cursor offsets stay those of
+        # the uncompressed lines
+        plainStat = os.stat(plainFile)
+        os.utime(tmpFile, (plainStat.st_atime, plainStat.st_mtime))
+        os.replace(tmpFile, compressedFile)
+        os.remove(plainFile)
+
+    def openSegment(self, seq):
+        if (os.path.exists(self.compressedFile(seq))):
+            return CompressedSegmentReader(self.compressedFile(seq))
+        return SegmentReader(self.segmentFile(seq))
+
+    def close(self):
+        self.seal()
+
+    # the sorted [start, end] byte ranges of the segment the server
+    # acknowledged, older cursors hold the end of the first one
+    def readCursor(self, seq):
+        try:
+            with open(self.cursorFile(seq)) as f:
+                cursor = json.loads(f.read().strip() or '0')
+        except Exception:
+            return []
+        if (isinstance(cursor, int)):
+            return [[0, cursor]] if cursor > 0 else []
+        return cursor
+
+    def writeCursor(self, seq, ranges):
+        writeFileDurably(self.cursorFile(seq), json.dumps(ranges))
+
+    def removeSegment(self, seq):
+        for file in [self.segmentFile(seq), self.compressedFile(seq), self.cursorFile(seq)]:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+    # upload the sealed segments with several batches in flight, each
+    # accepted batch is added to its segment's cursor and a segment is
+    # removed once all of it was accepted
+    def upload(self, sendBatch):
+        if (not self.uploadLock.acquire(False)):
+            # another upload is already running
+            return False
+        segmentLocks = {}
+        ackedRanges = {}
+        segmentEnds = {}
+        batches = None
+        try:
+            self.seal()
+            with self.lock:
+                seqs = [seq for seq in self.listSegments() if seq != self.activeSeq]
+            batches = self.iterUploadBatches(seqs, segmentLocks, ackedRanges)
+
+            def acknowledgeBatch(tokens):
+                ackedSeqs = set()
+                for seq, start, end in tokens:
+                    if (start is None):
+                        # every batch of the segment has been read
+                        segmentEnds[seq] = end
+                    else:
+                        ackedRanges[seq] = addRange(ackedRanges[seq], start, end)
+                    ackedSeqs.add(seq)
+                for seq in ackedSeqs:
+                    if (seq in segmentEnds and isRangeAcked(ackedRanges[seq], 0, segmentEnds[seq])):
+                        self.removeSegment(seq)
+                        segmentLocks.pop(seq).remove()
+                    else:
+                        # resume from here if the upload gets interrupted
+                        self.writeCursor(seq, ackedRanges[seq])
+
+            return uploadBatches(PAYLOADS_API, batches, sendBatch, acknowledgeBatch)
+        finally:
+            if (batches is not None):
+                batches.close()
+            for segmentLock in segmentLocks.values():
+                segmentLock.release()
+            self.uploadLock.release()
+
+    def segmentExists(self, seq):
+        return os.path.exists(self.segmentFile(seq)) or os.path.exists(self.compressedFile(seq))
+
+    # yields the batches of the segments, the tokens are (seq, start, end)
+    # of the lines, with a (seq, None, end) after each segment's last line.
+    # Locks each segment in segmentLocks and reads its cursor into
+    # ackedRanges as it gets to it.
+    def iterUploadBatches(self, seqs, segmentLocks, ackedRanges):
+        for seq in seqs:
+            segmentLock = FileLock(self.segmentFile(seq))
+            if (not segmentLock.acquire(False)):
+                # active in, or being uploaded by, another instance
+                continue
+            segmentLocks[seq] = segmentLock
+            ackedRanges[seq] = self.readCursor(seq)
+            end = getAckedPrefix(ackedRanges[seq])
+            if (self.segmentExists(seq)):
+                with self.openSegment(seq) as reader:
+                    lines = iterPayloadLines(reader.iterLines(end))
+                    for batch in iterBatches(iterSegmentItems(seq, lines, ackedRanges[seq], end), payloadBatchSize):
+                        end = batch[-1][0][2]
+                        yield batch
+            # else uploaded by another instance in the meantime
+            yield [((seq, None, end), None)]
+
+    # roll the sealed payloads up into one per project and hour once there
+    # are more than minPayloads, returns the number of payloads merged away
+    def compact(self, minPayloads):
+        merged = self.compactSegments(minPayloads)
+        if (merged > 0):
+            self.compressSealedSegments()
+        return merged
+
+    def compactSegments(self, minPayloads):
+        if (not self.uploadLock.acquire(False)):
+            # the payloads are being uploaded
+            return 0
+        segmentLocks = []
+        try:
+            with self.lock:
+                seqs = [seq for seq in self.listSegments() if seq != self.activeSeq]
+            for seq in seqs:
+                segmentLock = FileLock(self.segmentFile(seq))
+                if (segmentLock.acquire(False)):
+                    segmentLocks.append((seq, segmentLock))
+            seqs = [seq for seq, segmentLock in segmentLocks if self.segmentExists(seq)]
+            if (self.countPayloads(seqs) <= minPayloads):
+                return 0
+
+            counter = [0]
+            rollups = rollupPayloads(self.iterPendingPayloads(seqs, counter))
+            if (len(rollups) >= counter[0]):
+                # no project has two payloads in an hour, rewriting
+                # the segments wouldn't make them any smaller
+                return 0
+            if (rollups):
+                seq, rollupLock, rollupFile = self.createSegment()
+                with rollupFile:
+                    rollupFile.write(''.join(json.dumps(rollup) + '\n' for rollup in rollups).encode('utf-8'))
+                    rollupFile.flush()
+                    os.fsync(rollupFile.fileno())
+                # dated by its payloads rather than by when they were rolled
+                # up, so the offline data budget still sees their age
+                newestStart = max(int(rollup.get("start", 0)) for rollup in rollups)
+                if (newestStart > 0):
+                    os.utime(self.segmentFile(seq), (newestStart, newestStart))
+                rollupLock.release()
+
+            # a crash before this point uploads the hours twice, never loses them
+            for seq, segmentLock in segmentLocks:
+                self.removeSegment(seq)
+                segmentLock.remove()
+            return counter[0] - len(rollups)
+        finally:
+            for seq, segmentLock in segmentLocks:
+                segmentLock.release()
+            self.uploadLock.release()
+
+    # the payloads of the segments not uploaded yet, counter[0] counts them
+    def iterPendingPayloads(self, seqs, counter):
+        for seq in seqs:
+            ranges = self.readCursor(seq)
+            start = getAckedPrefix(ranges)
+            with self.openSegment(seq) as reader:
+                for end, payload in iterPayloads(reader.iterLines(start)):
+                    if (payload is not None and not isRangeAcked(ranges, start, end)):
+                        counter[0] += 1
+                        yield payload
+                    start = end
+
+    def countPayloads(self, seqs):
+        count = 0
+        for seq in seqs:
+            try:
+                ranges = self.readCursor(seq)
+                prefix = getAckedPrefix(ranges)
+                with self.openSegment(seq) as reader:
+                    count += reader.countLines(prefix)
+                    # the ranges accepted past a batch that wasn't
+                    for start, end in ranges:
+                        if (start >= prefix):
+                            count -= reader.countLines(start) - reader.countLines(end)
+            except Exception:
+                pass
+        return count
+
+    # (seq, size, mtime) of the segments on disk, oldest first. The mtime is
+    # when the segment was last appended to, or the start of the newest
+    # payload of a rolled up segment.
+    def statSegments(self):
+        with self.lock:
+            seqs = self.listSegments()
+        stats = []
+        for seq in seqs:
+            for file in [self.compressedFile(seq), self.segmentFile(seq)]:
+                fileStat = getFileStat(file)
+                if (fileStat is not None):
+                    stats.append((seq, fileStat[1], fileStat[0]))
+                    break
+        return stats
+
+    def pendingBytes(self):
+        return sum(size for seq, size, mtime in self.statSegments())
+
+    # the time of the segment with the oldest data, None without segments
+    def oldestSegmentTime(self):
+        stats = self.statSegments()
+        return min(mtime for seq, size, mtime in stats) if stats else None
+
+    # drop the sealed segments dated before cutoffTime, then the oldest
+    # until at most maxBytes are left. Returns (payloads, bytes) dropped.
+    def evict(self, maxBytes, cutoffTime):
+        if (not self.uploadLock.acquire(False)):
+            return (0, 0)
+        try:
+            # rolled up segments hold older data than their seq tells
+            stats = sorted(self.statSegments(), key=lambda stat: stat[2])
+            total = sum(size for seq, size, mtime in stats)
+            droppedPayloads = 0
+            droppedBytes = 0
+            for seq, size, mtime in stats:
+                if (mtime >= cutoffTime and total <= maxBytes):
+                    break
+                if (seq == self.activeSeq):
+                    continue
+                segmentLock = FileLock(self.segmentFile(seq))
+                if (not segmentLock.acquire(False)):
+                    continue
+                try:
+                    droppedPayloads += self.countPayloads([seq])
+                    self.removeSegment(seq)
+                    segmentLock.remove()
+                finally:
+                    segmentLock.release()
+                droppedBytes += size
+                total -= size
+            return (droppedPayloads, droppedBytes)
+        finally:
+            self.uploadLock.release()
+
+#
+# Reads a segment through a read-only memory map, so even a segment of
+# hundreds of MB is never loaded at once. The start offsets of the lines
+# are kept in a compact index once it's built.
+#
+class SegmentReader():
+    def __init__(self, file):
+        self.file = file
+        self.fileObj = None
+        self.map = None
+        self.size = 0
+        self.lineOffsets = None
+
+    def __enter__(self):
+        self.fileObj = open(self.file, 'rb')
+        self.size = os.fstat(self.fileObj.fileno()).st_size
+        if (self.size > 0):
+            self.map = mmap.mmap(self.fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if (self.map is not None):
+            self.map.close()
+            self.map = None
+        self.fileObj.close()
+        return False
+
+    # yields (end offset, line bytes) from offset on
+    def iterLines(self, offset):
+        pos = offset
+        while (self.map is not None and pos < self.size):
+            end = self.map.find(b'\n', pos)
+            if (end == -1):
+                # torn by a crash, there's nothing after it
+                log("Code Time: Skipping an incomplete payload in the offline data")
+                yield (self.size, None)
+                return
+            yield (end + 1, self.map[pos:end])
+            pos = end + 1
+
+    # index the start offset of every complete line
+    def buildIndex(self):
+        if (self.lineOffsets is not None):
+            return self.lineOffsets
+        self.lineOffsets = array('q')
+        pos = 0
+        while (self.map is not None and pos < self.size):
+            end = self.map.find(b'\n', pos)
+            if (end == -1):
+                break
+            self.lineOffsets.append(pos)
+            pos = end + 1
+        return self.lineOffsets
+
+    # number of complete lines starting at or after offset
+    def countLines(self, offset):
+        lineOffsets = self.buildIndex()
+        return len(lineOffsets) - bisect.bisect_left(lineOffsets, offset)
+
+#
+# Streams the lines of a zlib compressed segment, offsets are
+# those of the uncompressed lines.
+#
+class CompressedSegmentReader():
+    def __init__(self, file):
+        self.file = file
+        self.fileObj = None
+
+    def __enter__(self):
+        self.fileObj = open(self.file, 'rb')
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.fileObj.close()
+        return False
+
+    # yields (end offset, line bytes) from offset on
+    def iterLines(self, offset):
+        self.fileObj.seek(0)
+        decompressor = zlib.decompressobj()
+        pending = b''
+        # uncompressed offset of the start of pending
+        pos = 0
+        while True:
+            chunk = self.fileObj.read(COMPRESSED_READ_BYTES)
+            if (chunk):
+                pending += decompressor.decompress(chunk)
+            else:
+                pending += decompressor.flush()
+
+            start = 0
+            while True:
+                end = pending.find(b'\n', start)
+                if (end == -1):
+                    break
+                if (pos + start >= offset):
+                    yield (pos + end + 1, pending[start:end])
+                start = end + 1
+            pos += start
+            pending = pending[start:]
+
+            if (not chunk):
+                break
+
+        if (pending and pos >= offset):
+            log("Code Time: Skipping an incomplete payload in the offline data")
+            yield (pos + len(pending), None)
+
+    def countLines(self, offset):
+        count = 0
+        for end, line in self.iterLines(offset):
+            if (line is not None):
+                count += 1
+        return count
+
+# yields ((seq, start, end), payload json or None) for the lines from
+# iterPayloadLines starting at start, the acked ones without their json
+def iterSegmentItems(seq, lines, ranges, start):
+    for end, line in lines:
+        if (isRangeAcked(ranges, start, end)):
+            line = None
+        yield ((seq, start, end), line)
+        start = end
+
+# the sorted, merged ranges with [start, end] added
+def addRange(ranges, start, end):
+    if (start >= end):
+        return ranges
+    merged = []
+    for rangeStart, rangeEnd in sorted(ranges + [[start, end]]):
+        if (merged and rangeStart <= merged[-1][1]):
+            merged[-1][1] = max(merged[-1][1], rangeEnd)
+        else:
+            merged.append([rangeStart, rangeEnd])
+    return merged
+
+# True if [start, end] lies within one of the merged ranges
+def isRangeAcked(ranges, start, end):
+    if (start >= end):
+        return True
+    for rangeStart, rangeEnd in ranges:
+        if (rangeStart <= start and end <= rangeEnd):
+            return True
+    return False
+
+# where the first byte not acknowledged yet can be
+def getAckedPrefix(ranges):
+    if (ranges and ranges[0][0] <= 0):
+        return ranges[0][1]
+    return 0
+
+# yields (end offset, payload or None) decoding the lines lazily
+def iterPayloads(lines):
+    for end, line in lines:
+        yield (end, decodePayloadLine(line))
+
+# yields (end offset, payload json or None) for uploads, the
+# lines are only checked, never decoded
+def iterPayloadLines(lines):
+    for end, line in lines:
+        if (line is not None and not isPayloadLine(line)):
+            if (line.strip()):
+                log("Code Time: Skipping an unreadable payload in the offline data")
+            line = None
+        yield (end, line)
+
+def decodePayloadLine(line):
+    if (line is None):
+        return None
+    line = line.strip()
+    if (not line):
+        return None
+    try:
+        return json.loads(line.decode('utf-8'))
+    except Exception:
+        log("Code Time: Skipping an unreadable payload in the offline data")
+        return None
+
+offlineJournal = OfflineJournal()
@@ -0,0 +1,107 @@
+# Copyright (c) 2018 by Software.com
+from collections import OrderedDict
+from threading import Lock
+import json
+import os
+import time
+from .SoftwareUtil import *
+
+LINE_COUNTS_CAPACITY = 5000
+# changed counts are written at most this often, and when unloaded
+LINE_COUNTS_SAVE_INTERVAL_SEC = 5 * 60
+
+def getLineCountsFile():
+    file = getSoftwareDir(True)
+    return os.path.join(file, 'lineCounts.json')
+
+#
+# Last known line count per file, least recently used files get evicted.
+# The counts are persisted in ~/.software and restored on first use,
+# a restored count is only trusted while the file is unchanged on disk.
+#
+class LineCountCache():
+    def __init__(self, capacity=LINE_COUNTS_CAPACITY):
+        self.capacity = capacity
+        # fileName => [lines, mtime, size, verified]
+        self.entries = OrderedDict()
+        self.loaded = False
+        self.dirty = False
+        self.savedAt = time.monotonic()
+        self.lock = Lock()
+
+    def get(self, fileName):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(fileName)
+            if (entry is None):
+                return None
+
+            if (not entry[3]):
+                # restored from disk, make sure the file didn't change since
+                stat = getFileStat(fileName)
+                if (stat is None or stat != (entry[1], entry[2])):
+                    del self.entries[fileName]
+                    self.dirty = True
+                    return None
+                entry[3] = True
+
+            self.entries.move_to_end(fileName)
+            return entry[0]
+
+    def put(self, fileName, lines):
+        if (lines is None or lines < 0):
+            return
+        stat = getFileStat(fileName)
+        if (stat is None):
+            # untitled or deleted files aren't worth keeping
+            return
+        with self.lock:
+            self.load()
+            entry = self.entries.get(fileName)
+            if (entry is not None and entry[:3] == [lines, stat[0], stat[1]]):
+                entry[3] = True
+                self.entries.move_to_end(fileName)
+                return
+            self.entries[fileName] = [lines, stat[0], stat[1], True]
+            self.entries.move_to_end(fileName)
+            while (len(self.entries) > self.capacity):
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        if (self.loaded):
+            return
+        self.loaded = True
+        try:
+            with open(getLineCountsFile()) as f:
+                rows = json.load(f)
+            # saved from the least to the most recently used
+            for fileName, lines, mtime, size in rows[-self.capacity:]:
+                self.entries[fileName] = [lines, mtime, size, False]
+        except Exception:
+            pass
+
+    # write the changed counts if the last write was a while ago, or now
+    # when forced
+    def save(self, force=False):
+        with self.lock:
+            if (not self.dirty):
+                return
+            now = time.monotonic()
+            if (not force and now - self.savedAt < LINE_COUNTS_SAVE_INTERVAL_SEC):
+                return
+            rows = [[fileName, entry[0], entry[1], entry[2]] for fileName, entry in self.entries.items()]
+            self.dirty = False
+            self.savedAt = now
+
+        try:
+            file = getLineCountsFile()
+            tmpFile = file + '.tmp'
+            with open(tmpFile, 'w') as f:
+                json.dump(rows, f, separators=(',', ':'))
+            os.replace(tmpFile, file)
+        except Exception as ex:
+            log("Code Time: Unable to save the line counts: %s" % ex)
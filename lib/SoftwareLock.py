@@ -0,0 +1,70 @@
+# Copyright (c) 2018 by Software.com
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+#
+# Advisory lock shared by the editor instances, held on a .lock file next
+# to the data file so it stays held while the data file gets replaced.
+# It's a no-op where neither fcntl nor msvcrt is available.
+#
+class FileLock():
+    def __init__(self, file):
+        self.lockFile = file + '.lock'
+        self.fileObj = None
+
+    # False when blocking is False and another process holds the lock
+    def acquire(self, blocking=True):
+        self.fileObj = open(self.lockFile, 'a+')
+        try:
+            if (fcntl is not None):
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(self.fileObj.fileno(), flags)
+            elif (msvcrt is not None):
+                self.fileObj.seek(0)
+                # LK_LOCK retries for about 10 seconds before raising
+                mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+                msvcrt.locking(self.fileObj.fileno(), mode, 1)
+        except OSError:
+            self.fileObj.close()
+            self.fileObj = None
+            if (blocking):
+                raise
+            return False
+        return True
+
+    def release(self):
+        if (self.fileObj is None):
+            return
+        try:
+            if (fcntl is not None):
+                fcntl.flock(self.fileObj.fileno(), fcntl.LOCK_UN)
+            elif (msvcrt is not None):
+                self.fileObj.seek(0)
+                msvcrt.locking(self.fileObj.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.fileObj.close()
+            self.fileObj = None
+
+    # release the lock and delete the lock file, once the data file is gone
+    def remove(self):
+        self.release()
+        try:
+            os.remove(self.lockFile)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+        return False
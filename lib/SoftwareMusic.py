@@ -1,4 +1,3 @@
-from threading import Thread, Timer, Event
 import sublime_plugin, sublime
 import copy
 import time
@@ -97,7 +96,3 @@ def gatherMusicInfo():
 
 		# re-initialize the current track info to an empty object
 		currentTrackInfo = {}
-
-	# fetch the daily kpm session info in 15 seconds
-	gatherMusicInfoTimer = Timer(15, gatherMusicInfo)
-	gatherMusicInfoTimer.start()
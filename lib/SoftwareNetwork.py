@@ -0,0 +1,278 @@
+
+# Copyright (c) 2018 by Software.com
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import threading
+from .SoftwareHttp import *
+
+# threads sending the requests of every api path
+NETWORK_WORKERS = 8
+# requests in flight at once by api path, the rest wait their turn. The
+# uploads stay below POOL_MAX_CONNECTIONS so the other requests still
+# get a connection.
+ENDPOINT_CONCURRENCY = {
+    "/data/batch": 3,
+    "/commits": 2,
+}
+DEFAULT_ENDPOINT_CONCURRENCY = 2
+# the api the stored kpm payloads are uploaded to
+PAYLOADS_API = "/data/batch"
+# batch sizes in json bytes, each upload grows its batches by the
+# increase while the requests are fast and halves them after a slow
+# or failed one
+BATCH_MIN_BYTES = 16 * 1024
+BATCH_INCREASE_BYTES = 32 * 1024
+BATCH_SLOW_SEC = 5
+
+# what became of a sent batch: accepted, failed for now and sent again
+# by the next upload, or refused for what it holds
+BATCH_ACCEPTED = "accepted"
+BATCH_RETRY = "retry"
+BATCH_REFUSED = "refused"
+# the client errors worth sending the same batch again for, or that
+# the api answers every request with, like a revoked token or a moved api
+RETRY_STATUSES = (401, 403, 404, 408, 429)
+# requests one upload may send for the halves of the refused batches
+MAX_SPLIT_REQUESTS = 32
+
+def getEndpointConcurrency(api):
+    return ENDPOINT_CONCURRENCY.get(api.split("?")[0], DEFAULT_ENDPOINT_CONCURRENCY)
+
+#
+# Worker threads sending the plugin's requests, at most
+# getEndpointConcurrency(api) at a time for each api path. The
+# calls return futures, so a caller can keep several requests
+# in flight and still handle the outcomes in its own thread.
+#
+class NetworkEngine():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.active = {}
+        self.waiting = {}
+
+    # run func(*args) on a worker once the api path has a free slot
+    def submit(self, api, func, *args):
+        future = Future()
+        path = api.split("?")[0]
+        with self.lock:
+            if (self.active.get(path, 0) < getEndpointConcurrency(path)):
+                self.active[path] = self.active.get(path, 0) + 1
+                self.start(path, future, func, args)
+            else:
+                self.waiting.setdefault(path, deque()).append((future, func, args))
+        return future
+
+    def start(self, path, future, func, args):
+        if (self.executor is None):
+            self.executor = ThreadPoolExecutor(max_workers=NETWORK_WORKERS)
+        self.executor.submit(self.run, path, future, func, args)
+
+    def run(self, path, future, func, args):
+        try:
+            if (future.set_running_or_notify_cancel()):
+                try:
+                    future.set_result(func(*args))
+                except Exception as ex:
+                    future.set_exception(ex)
+        finally:
+            self.next(path)
+
+    # hand the slot to the next waiting call of the api path
+    def next(self, path):
+        with self.lock:
+            waiting = self.waiting.get(path)
+            if (waiting and self.executor is not None):
+                future, func, args = waiting.popleft()
+                self.start(path, future, func, args)
+            else:
+                self.active[path] = max(0, self.active.get(path, 0) - 1)
+
+    # cancel the waiting calls, the ones being sent finish on their own
+    def stop(self):
+        with self.lock:
+            for waiting in self.waiting.values():
+                for future, func, args in waiting:
+                    future.cancel()
+            self.waiting = {}
+            self.active = {}
+            executor = self.executor
+            self.executor = None
+        if (executor is not None):
+            executor.shutdown(wait=False)
+
+networkEngine = NetworkEngine()
+
+#
+# The size of an api's upload batches, increased additively while the
+# api answers quickly and decreased multiplicatively after a slow
+# answer, a failure or a 413, never beyond the api's max body size. A
+# 413 also lowers that max below the refused size.
+#
+class AdaptiveBatchSize():
+    def __init__(self, initialBytes, maxBytes):
+        self.lock = threading.Lock()
+        self.batchBytes = initialBytes
+        self.maxBytes = maxBytes
+
+    def getBatchBytes(self):
+        with self.lock:
+            return self.batchBytes
+
+    # the outcome of sending a bodyBytes batch, response is None if
+    # the request failed
+    def record(self, bodyBytes, seconds, response):
+        with self.lock:
+            if (response is not None and int(response.status) == 413):
+                # the api's limit is below what was refused, never grow
+                # back to it and start over well below it
+                self.maxBytes = max(BATCH_MIN_BYTES, min(self.maxBytes, bodyBytes * 3 // 4))
+                self.batchBytes = min(self.batchBytes, bodyBytes) // 2
+            elif (response is None or int(response.status) >= 500 or seconds > BATCH_SLOW_SEC):
+                self.batchBytes = self.batchBytes // 2
+            elif (bodyBytes * 2 >= self.batchBytes):
+                # only batches using most of the size tell it could be larger
+                self.batchBytes += BATCH_INCREASE_BYTES
+            self.batchBytes = max(BATCH_MIN_BYTES, min(self.batchBytes, self.maxBytes))
+
+payloadBatchSize = AdaptiveBatchSize(64 * 1024, 1024 * 1024)
+commitBatchSize = AdaptiveBatchSize(64 * 1024, 512 * 1024)
+
+# yields batches, lists of the (token, line) items holding as many
+# lines as fit in the batch size's current bytes, at least one. Items
+# without a line go along with the next batch so their tokens are
+# acknowledged with it, the last batch may have no lines.
+def iterBatches(items, batchSize, sizeOf=len):
+    batch = []
+    batchBytes = 0
+    maxBytes = batchSize.getBatchBytes()
+    for token, line in items:
+        if (line is not None):
+            size = sizeOf(line) + 1
+            if (batchBytes > 0 and batchBytes + size > maxBytes):
+                yield batch
+                batch = []
+                batchBytes = 0
+                maxBytes = batchSize.getBatchBytes()
+            batchBytes += size
+        batch.append((token, line))
+    if (batch):
+        yield batch
+
+def getBatchLines(batch):
+    return [line for token, line in batch if line is not None]
+
+# the two halves of a batch holding more than one line
+def splitBatch(batch):
+    lineIndexes = [i for i, (token, line) in enumerate(batch) if line is not None]
+    middle = lineIndexes[len(lineIndexes) // 2]
+    return [batch[:middle], batch[middle:]]
+
+def getBatchOutcome(response):
+    if (isResponsOk(response)):
+        return BATCH_ACCEPTED
+    status = int(response.status) if response is not None else None
+    if (status is None or status < 400 or status >= 500 or status in RETRY_STATUSES):
+        return BATCH_RETRY
+    return BATCH_REFUSED
+
+# send the batches from iterBatches through sendBatch(lines), which
+# returns the batch's outcome, with several in flight at once.
+# onAck(tokens) is called in the caller's thread with the tokens of each
+# batch the server accepted, whatever happened to the batches sent
+# before it, so nothing accepted is ever sent again. Batches without
+# lines are acknowledged without a request.
+#
+# A refused batch is split and its halves sent again until the payload
+# refused on its own is found, which is dropped by acknowledging it.
+# That's only done once the api accepted some payloads of the upload,
+# until then only the first refused batch is split, to tell whether the
+# api refuses these payloads or every request. No more batches are sent
+# after one failed for now, after every batch was refused or after
+# MAX_SPLIT_REQUESTS, True if none of that happened.
+def uploadBatches(api, batches, sendBatch, onAck):
+    inFlight = deque()
+    # the halves of the refused batches, sent before the next batches
+    splitBatches = deque()
+    # refused while no payload of the upload was accepted yet
+    unprovenBatches = []
+    splitRequests = [0]
+    batches = iter(batches)
+    accepted = True
+    anyAccepted = False
+    concurrency = getEndpointConcurrency(api)
+
+    # split the refused batch, or drop its only payload. False once
+    # the upload sent as many halves as it may.
+    def refuseBatch(batch):
+        lines = getBatchLines(batch)
+        if (len(lines) == 1):
+            # sending it again would only be refused again
+            httpLog("Code Time: Dropping a payload " + api + " refused: %s" % lines[0][:200])
+            onAck([token for token, line in batch])
+            return True
+        if (splitRequests[0] >= MAX_SPLIT_REQUESTS):
+            httpLog("Code Time: " + api + " refused too many batches, sending them again later")
+            return False
+        splitRequests[0] += 2
+        splitBatches.extend(splitBatch(batch))
+        return True
+
+    try:
+        while True:
+            while (accepted and len(inFlight) < concurrency):
+                if (splitBatches):
+                    batch = splitBatches.popleft()
+                elif (not anyAccepted and (unprovenBatches or splitRequests[0] > 0)):
+                    # wait for the halves to tell what the api refuses
+                    break
+                else:
+                    batch = next(batches, None)
+                if (batch is None):
+                    break
+                lines = getBatchLines(batch)
+                if (lines):
+                    future = networkEngine.submit(api, sendBatch, lines)
+                else:
+                    future = Future()
+                    future.set_result(BATCH_ACCEPTED)
+                inFlight.append((future, batch))
+
+            if (not inFlight):
+                if (accepted and unprovenBatches):
+                    httpLog("Code Time: " + api + " refused every batch, sending them again later")
+                    accepted = False
+                return accepted
+
+            future, batch = inFlight.popleft()
+            outcome = BATCH_RETRY
+            if (not future.cancelled()):
+                try:
+                    outcome = future.result()
+                except Exception as ex:
+                    httpLog("Code Time: " + api + " upload error: %s" % ex)
+            handled = True
+            if (outcome == BATCH_ACCEPTED):
+                onAck([token for token, line in batch])
+                if (getBatchLines(batch) and not anyAccepted):
+                    # the refused batches hold payloads the api won't take
+                    anyAccepted = True
+                    for unprovenBatch in unprovenBatches:
+                        handled = refuseBatch(unprovenBatch) and handled
+                    unprovenBatches = []
+            elif (outcome == BATCH_REFUSED):
+                if (anyAccepted or (splitRequests[0] == 0 and not unprovenBatches and len(getBatchLines(batch)) > 1)):
+                    handled = refuseBatch(batch)
+                else:
+                    unprovenBatches.append(batch)
+            else:
+                handled = False
+            if (not handled and accepted):
+                # the next upload sends it again, the batches not sent
+                # yet needn't be now
+                accepted = False
+                for future, batch in inFlight:
+                    future.cancel()
+    finally:
+        for future, batch in inFlight:
+            future.cancel()
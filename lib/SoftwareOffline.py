@@ -1,14 +1,14 @@
+from threading import Lock
 import sublime_plugin, sublime
-from threading import Thread, Timer, Event
 import json
 import os.path
 import time
 import datetime
 import math
 from .SoftwareUtil import *
+from .SoftwareJournal import *
 
 # Constants
-sessionSummaryData = None
 lastDayOfMonth = 0
 SERVICE_NOT_AVAIL = "Our service is temporarily unavailable.\n\nPlease try again later.\n"
 ONE_MINUTE_IN_SEC = 60
@@ -17,11 +17,20 @@ LONG_THRESHOLD_HOURS = 12
 SHORT_THRESHOLD_HOURS = 4
 NO_TOKEN_THRESHOLD_HOURS = 2
 LOGIN_LABEL = "Log in"
+TOP_FILES_LIMIT = 5
+# sessionSummary.json is written this long after the summary changed
+SUMMARY_WRITE_DELAY_SEC = 5
+# how often the summary checks whether another editor wrote the file
+SUMMARY_CHECK_INTERVAL_SEC = 5
+# the offline payloads get rolled up into hourly ones past this many
+COMPACT_MIN_PAYLOADS = 500
+
+# payloads rolled up or dropped to keep the offline data within its budget
+offlineDataCounters = {"compacted": 0, "dropped": 0, "droppedBytes": 0}
 
 # init the session summary data
 def initSessionSumaryData():
-    global sessionSummaryData
-    sessionSummaryData = {
+    return {
         "currentDayMinutes": 0,
         "averageDailyMinutes": 0,
         "averageDailyKeystrokes": 0,
@@ -31,10 +40,7 @@ def initSessionSumaryData():
 
 # get the session summary data
 def getSessionSummaryData():
-    global sessionSummaryData
-    if (sessionSummaryData is None):
-        sessionSummaryData = getSessionSummaryFileAsJson()
-    return sessionSummaryData
+    return sessionSummary.get()
 
 # get the session summary file
 def getSessionSummaryFile():
@@ -46,16 +52,11 @@ def getSummaryInfoFile():
     return os.path.join(file, 'SummaryInfo.txt')
 
 def incrementSessionSummaryData(minutes, keystrokes):
-    global sessionSummaryData
-    if (sessionSummaryData is None):
-        sessionSummaryData = getSessionSummaryFileAsJson()
-    sessionSummaryData["currentDayMinutes"] += minutes
-    sessionSummaryData["currentDayKeystrokes"] += keystrokes
+    sessionSummary.increment(minutes, keystrokes)
 
 #
 def updateStatusBarWithSummaryData():
-    global sessionSummaryData
-    sessionSummaryData = getSessionSummaryFileAsJson()
+    sessionSummaryData = getSessionSummaryData()
 
     currentDayInfo = getCurrentDayTime(sessionSummaryData)
     averageDailyInfo = getAverageDailyTime(sessionSummaryData)
@@ -92,25 +93,107 @@ def getAverageDailyTime(sessionSummaryData):
 
 
 def saveSessionSummaryToDisk(sessionSummaryData):
-    content = json.dumps(sessionSummaryData)
-
-    sessionFile = getSessionSummaryFile()
-    with open(sessionFile, 'w') as f:
-        f.write(content)
+    sessionSummary.replace(sessionSummaryData)
 
 #
-def getSessionSummaryFileAsJson():
-    global sessionSummaryData
-    try:
-        with open(getSessionSummaryFile()) as sessionSummaryFile:
-            sessionSummaryData = json.load(sessionSummaryFile)
-    except Exception as ex:
-        initSessionSumaryData()
-        log("Code Time: Session summary file fetch error: %s" % ex)
-    return sessionSummaryData
+# The session summary shown in the status bar, kept in memory and written
+# to sessionSummary.json shortly after it changes. The file is re-read
+# only when another editor wrote it, the minutes and keystrokes not
+# written yet are added on top of what it has.
+#
+class SessionSummary():
+    def __init__(self):
+        self.lock = Lock()
+        self.data = None
+        # (mtime, size) of the file when it was last read or written
+        self.fileStat = None
+        self.checkedAt = 0
+        # counted since the last write
+        self.pendingMinutes = 0
+        self.pendingKeystrokes = 0
+        # the server sent a new summary that isn't written yet
+        self.replaced = False
+        self.writeJob = None
+
+    def get(self):
+        with self.lock:
+            self.refresh()
+            return self.data
+
+    def increment(self, minutes, keystrokes):
+        with self.lock:
+            self.refresh()
+            self.data["currentDayMinutes"] = self.data.get("currentDayMinutes", 0) + minutes
+            self.data["currentDayKeystrokes"] = self.data.get("currentDayKeystrokes", 0) + keystrokes
+            self.pendingMinutes += minutes
+            self.pendingKeystrokes += keystrokes
+            self.saveLater()
+
+    # the summary fetched from the server
+    def replace(self, data):
+        with self.lock:
+            self.data = data
+            self.pendingMinutes = 0
+            self.pendingKeystrokes = 0
+            self.replaced = True
+            self.saveLater()
+
+    def saveLater(self):
+        if (self.writeJob is None):
+            self.writeJob = runLater(SUMMARY_WRITE_DELAY_SEC, self.save)
+
+    def isDirty(self):
+        return self.replaced or self.pendingMinutes != 0 or self.pendingKeystrokes != 0
+
+    # reload the file if another editor changed it
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if (self.data is not None and not force and now - self.checkedAt < SUMMARY_CHECK_INTERVAL_SEC):
+            return
+        self.checkedAt = now
+        sessionFile = getSessionSummaryFile()
+        fileStat = getFileStat(sessionFile)
+        if (self.data is not None and (self.replaced or (not force and fileStat == self.fileStat))):
+            return
+
+        data = readJsonFile(sessionFile)
+        if (data is None):
+            if (self.data is not None):
+                # missing or unreadable, keep the counts we have rather
+                # than starting over from zero
+                return
+            data = initSessionSumaryData()
+        self.data = self.merge(data)
+        self.fileStat = fileStat
+
+    # the other editor's summary plus what was counted here since the last write
+    def merge(self, data):
+        data["currentDayMinutes"] = data.get("currentDayMinutes", 0) + self.pendingMinutes
+        data["currentDayKeystrokes"] = data.get("currentDayKeystrokes", 0) + self.pendingKeystrokes
+        return data
+
+    def save(self):
+        with self.lock:
+            self.writeJob = None
+            if (not self.isDirty()):
+                return
+            sessionFile = getSessionSummaryFile()
+            try:
+                with FileLock(sessionFile):
+                    # merge with what the other editors wrote in the meantime
+                    self.refresh(True)
+                    writeFileAtomically(sessionFile, json.dumps(self.data))
+                    self.fileStat = getFileStat(sessionFile)
+            except Exception as ex:
+                log("Code Time: Unable to save the session summary: %s" % ex)
+                return
+            self.pendingMinutes = 0
+            self.pendingKeystrokes = 0
+            self.replaced = False
+
+sessionSummary = SessionSummary()
 
 def launchCodeTimeMetrics():
-    global sessionSummaryData
     online = getValue("online", True)
     sessionSummaryData = getSessionSummaryData()
     if (sessionSummaryData.get("currentDayMinutes", 0) == 0):
@@ -124,10 +207,9 @@ def launchCodeTimeMetrics():
 
     fetchCodeTimeMetricsDashboard(sessionSummaryData)
     file = getDashboardFile()
-    sublime.active_window().open_file(file)
+    sublime.set_timeout(lambda: sublime.active_window().open_file(file), 0)
 
 def fetchCodeTimeMetricsDashboard(summary):
-    global sessionSummaryData
     global lastDayOfMonth
 
     summaryInfoFile = getSummaryInfoFile()
@@ -172,12 +254,14 @@ def fetchCodeTimeMetricsDashboard(summary):
     dashboardContent += getSectionHeader(todayHeader)
 
     if (summary is not None):
-        hoursCodedToday = getCurrentDayTime(sessionSummaryData)["formatted"]
-        averageTime = getCurrentDayTime(sessionSummaryData)["formatted"]
+        hoursCodedToday = getCurrentDayTime(summary)["formatted"]
+        averageTime = getCurrentDayTime(summary)["formatted"]
         dashboardContent += getDashboardRow("Hours coded today", hoursCodedToday)
         dashboardContent += getDashboardRow("90-day avg", averageTime)
         dashboardContent += "\n"
 
+    dashboardContent += getTopFilesContent()
+
     if (os.path.exists(summaryInfoFile)):
         try:
             with open(summaryInfoFile, 'r', encoding="utf-8") as summaryInfoFileContent:
@@ -191,11 +275,27 @@ def fetchCodeTimeMetricsDashboard(summary):
     except Exception as ex:
         log("Code Time: Unable to write local dashboard content: %s" % ex)
 
+# today's most edited files from the local metrics store
+def getTopFilesContent():
+    today = getLocalStart() // SECONDS_PER_DAY
+    topFiles = metricsStore.getTopFiles(today, TOP_FILES_LIMIT)
+    if (not topFiles):
+        return ""
+
+    content = getSectionHeader("Top files today")
+    for projectDir, fileName, minutes, keystrokes in topFiles:
+        label = fileName
+        if (projectDir and fileName.startswith(projectDir)):
+            label = os.path.relpath(fileName, projectDir)
+        content += getDashboardRow(label, "%s, %d keystrokes" % (humanizeMinutes(minutes), keystrokes))
+    content += "\n"
+    return content
+
 #
 # Fetch and display the daily KPM info
 #
 def fetchDailyKpmSessionInfo(forceRefresh):
-    sessionSummaryData = getSessionSummaryFileAsJson()
+    sessionSummaryData = getSessionSummaryData()
     currentDayMinutes = sessionSummaryData.get("currentDayMinutes", 0)
     if (currentDayMinutes == 0 or forceRefresh is True):
         online = getValue("online", True)
@@ -211,7 +311,7 @@ def fetchDailyKpmSessionInfo(forceRefresh):
         if (response is not None and isResponsOk(response)):
             sessionSummaryData = json.loads(response.read().decode('utf-8'))
 
-            # update the file
+            # keep it, the file gets written shortly
             saveSessionSummaryToDisk(sessionSummaryData)
 
             # update the status bar
@@ -226,33 +326,70 @@ def fetchDailyKpmSessionInfo(forceRefresh):
         updateStatusBarWithSummaryData()
         return { "data": sessionSummaryData, "status": "OK" }
 
-# store the payload offline...
-def storePayload(payload):
+# store the payloads of every project flushed in the same interval,
+# they're serialized here once and uploaded as they're stored
+def storePayloads(payloads):
 
     # calculate it and call add to the minutes
-    # convert it to json
-    payloadData = json.loads(payload)
-
-    keystrokes = payloadData.get("keystrokes", 0)
+    keystrokes = 0
+    for payload in payloads:
+        keystrokes += payload.get("keystrokes", 0)
 
+    # the projects share the same minute, the summary
+    # gets written so other editor windows can have it
     incrementSessionSummaryData(1, keystrokes)
 
-    # push the stats to the file so other editor windows can have it
-    saveSessionSummaryToDisk(getSessionSummaryData())
-
     # update the statusbar
     fetchDailyKpmSessionInfo(False)
 
-    # get the datastore file to save the payload
-    dataStoreFile = getSoftwareDataStoreFile()
+    lines = [json.dumps(payload) for payload in payloads]
+    for line in lines:
+        log("Code Time: storing kpm metrics: %s" % line)
+
+    # keep them in the metrics store, or the offline journal without one
+    if (not metricsStore.appendPayloads(payloads, lines)):
+        offlineJournal.append(lines)
+
+# roll a large backlog up into hourly payloads
+def compactOfflineData(minPayloads=COMPACT_MIN_PAYLOADS):
+    merged = metricsStore.compact(minPayloads) + offlineJournal.compact(minPayloads)
+    if (merged > 0):
+        offlineDataCounters["compacted"] += merged
+        log("Code Time: Rolled %d offline payloads up into hourly payloads" % merged)
+
+# keep the offline data within software_offline_max_mb and software_offline_max_days,
+# by rolling it up first and dropping the oldest payloads only if that's not enough
+def enforceOfflineBudget():
+    maxBytes = int(getValue("software_offline_max_mb", 50) * 1024 * 1024)
+    cutoff = round(time.time()) - int(getValue("software_offline_max_days", 30) * SECONDS_PER_DAY)
+
+    # the local history is kept as long, whether or not anything waits
+    metricsStore.pruneHistory(cutoff)
+
+    journalBytes = offlineJournal.pendingBytes()
+    oldest = [t for t in [metricsStore.oldestPendingStart(), offlineJournal.oldestSegmentTime()] if t is not None]
+    if (journalBytes + metricsStore.pendingBytes() <= maxBytes and (not oldest or min(oldest) >= cutoff)):
+        return
+
+    compactOfflineData(0)
 
-    log("Code Time: storing kpm metrics: %s" % payload)
+    journalDropped = offlineJournal.evict(maxBytes, cutoff)
+    storeMaxBytes = max(0, maxBytes - offlineJournal.pendingBytes())
+    storeDropped = metricsStore.evict(storeMaxBytes, cutoff)
 
-    with open(dataStoreFile, "a") as dsFile:
-        dsFile.write(payload + "\n")
+    dropped = journalDropped[0] + storeDropped[0]
+    droppedBytes = journalDropped[1] + storeDropped[1]
+    if (dropped > 0 or droppedBytes > 0):
+        offlineDataCounters["dropped"] += dropped
+        offlineDataCounters["droppedBytes"] += droppedBytes
+        log("Code Time: Dropped %d offline payloads (%d bytes) over the offline data budget" % (dropped, droppedBytes))
 
 # send the data that has been saved offline
 def sendOfflineData():
+    # also runs while logged out, when nothing gets uploaded
+    enforceOfflineBudget()
+    compactOfflineData()
+
     existingJwt = getItem("jwt")
 
     # no need to try to send the offline data if we don't have an auth token
@@ -261,48 +398,27 @@ def sendOfflineData():
 
     serverAvailable = checkOnline()
     if (serverAvailable):
-        # send the offline data
-        dataStoreFile = getSoftwareDataStoreFile()
-
-        if (os.path.exists(dataStoreFile)):
-            payloads = []
-
-            try:
-                with open(dataStoreFile) as fp:
-                    for line in fp:
-                        if (line and line.strip()):
-                            line = line.rstrip()
-                            # convert to object
-                            json_obj = json.loads(line)
-                            # convert to json to send
-                            payloads.append(json_obj)
-            except Exception:
-                log("Unable to read offline data file %s" % dataStoreFile)
-
-            if (payloads):
-                os.remove(dataStoreFile)
-
-                # go through the payloads array 50 at a time
-                batch = []
-                length = len(payloads)
-                for i in range(length):
-                    payload = payloads[i]
-                    if (len(batch) >= 50):
-                        requestIt("POST", "/data/batch", json.dumps(batch), getItem("jwt"))
-                        # send batch
-                        batch = []
-                    batch.append(payload)
-
-                # send remaining batch
-                if (len(batch) > 0):
-                    requestIt("POST", "/data/batch", json.dumps(batch), getItem("jwt"))
+        # send the offline data, the journal and the store
+        # only drop what the server acknowledged
+        if (offlineJournal.upload(sendOfflineBatch)):
+            metricsStore.upload(sendOfflineBatch)
 
     # update the statusbar
     fetchDailyKpmSessionInfo(True)
 
-    # send the next batch in 30 minutes
-    sendOfflineDataTimer = Timer(60 * 30, sendOfflineData)
-    sendOfflineDataTimer.start()
+# send a batch of json encoded payloads as they were stored, returns
+# the batch's outcome. It also sizes the next batches.
+def sendOfflineBatch(lines):
+    compress = getValue("software_gzip_requests", False)
+    body = encodeBatch(lines)
+    started = time.monotonic()
+    response = requestIt("POST", PAYLOADS_API, body, getItem("jwt"), compress)
+    payloadBatchSize.record(len(body), time.monotonic() - started, response)
+    return getBatchOutcome(response)
+
+# the json array of the encoded payloads, without decoding them
+def encodeBatch(lines):
+    return b'[' + b','.join(lines) + b']'
 
 def showLoginPrompt():
     serverAvailable = checkOnline()
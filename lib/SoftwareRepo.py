@@ -3,6 +3,7 @@ import time
 import re
 from urllib.parse import quote_plus
 from .SoftwareHttp import *
+from .SoftwareNetwork import *
 from .SoftwareUtil import *
 from .SoftwareSettings import *
 
@@ -145,33 +146,53 @@ def gatherCommits(rootDir):
 				commits.append(commit)
 
 			if (commits is not None and len(commits) > 0):
-				batchCommits = []
-				index = 0
-				for commit in commits:
-					batchCommits.append(commit)
-					if (index > 0 and index % 100 == 0):
-						commitData = {
-							'commits': batchCommits,
-							'identifier': identifier,
-							'tag': tag,
-							'branch': branch
-						}
-						sendCommits(commitData)
-					index += 1
-
-				if (len(batchCommits) > 0):
+				# oldest first, so the commit cursor only moves forward
+				commits.reverse()
+				# the ones accepted by an earlier gather past a batch that wasn't
+				acceptedIds = metricsStore.getSentCommitIds(key)
+				unsentCommits = [commit for commit in commits if commit['commitId'] not in acceptedIds]
+				batches = iterBatches(((commit, commit) for commit in unsentCommits), commitBatchSize, getJsonSize)
+				# commits[:cursor[0]] were all accepted
+				cursor = [0]
+
+				def sendBatch(batchCommits):
 					commitData = {
 						'commits': batchCommits,
 						'identifier': identifier,
 						'tag': tag,
 						'branch': branch
 					}
-					sendCommits(commitData)
-
+					return sendCommits(commitData)
+
+				# the next gather only needs the commits after the ones
+				# accepted without a gap
+				def moveCursor():
+					start = cursor[0]
+					while (cursor[0] < len(commits) and commits[cursor[0]]['commitId'] in acceptedIds):
+						cursor[0] += 1
+					if (cursor[0] > start):
+						latest = commits[cursor[0] - 1]
+						metricsStore.setCommitCursor(key, latest['commitId'], latest['timestamp'])
+
+				def acknowledgeBatch(batchCommits):
+					metricsStore.addSentCommits(key, batchCommits)
+					acceptedIds.update(commit['commitId'] for commit in batchCommits)
+					moveCursor()
+
+				moveCursor()
+				uploadBatches("/commits", batches, sendBatch, acknowledgeBatch)
+
+def getJsonSize(data):
+	return len(json.dumps(data))
+
+# True if the commits were accepted, the outcome sizes the next batches
 def sendCommits(commitData):
 	online = getValue("online", True)
 	if (online):
-		response = requestIt("POST", "/commits", json.dumps(commitData), getItem("jwt"))
+		body = json.dumps(commitData)
+		started = time.monotonic()
+		response = requestIt("POST", "/commits", body, getItem("jwt"))
+		commitBatchSize.record(len(body), time.monotonic() - started, response)
 		if (response is not None):
 			responseObjStr = response.read().decode('utf-8')
 			try:
@@ -179,8 +200,9 @@ def sendCommits(commitData):
 				log("Code Time: %s" % responseObj.get("message", "Repo commits update complete"))
 			except Exception as ex:
 				log("Code Time: Unable to complete repo commits metric update: %s" % ex)
+		return getBatchOutcome(response)
 	else:
-		return None
+		return BATCH_RETRY
 
 def buildRepoKey(identifier, branch, tag):
 	return "%s_%s_%s" % (identifier, branch, tag)
@@ -203,6 +225,11 @@ def getLastCommit(rootDir):
 
 		key = buildRepoKey(identifier, branch, tag)
 
+		# the latest commit sent from here
+		latestCommit = metricsStore.getCommitCursor(key)
+		if (latestCommit is not None):
+			return latestCommit
+
     	# fetch the latest commit from the app
 		encodedIdentifier = quote_plus(identifier) 
 		encodedTag = quote_plus(tag)
@@ -0,0 +1,62 @@
+# Copyright (c) 2018 by Software.com
+from collections import OrderedDict
+
+SECONDS_PER_ROLLUP = 60 * 60
+
+# per file counts that add up when payloads are rolled up
+SUMMED_FILE_FIELDS = ('add', 'delete', 'paste', 'netkeys', 'linesAdded', 'linesRemoved', 'open', 'close')
+
+# cheap check that a stored json line is a whole payload, it gets
+# uploaded without being decoded
+def isPayloadLine(line):
+    line = line.strip()
+    return line.startswith(b'{') and line.endswith(b'}')
+
+#
+# Rolls minute payloads up into one payload per project and hour, the
+# files of a rollup keep their summed counts, the earliest start and the
+# latest end, lines and length.
+#
+
+def getRollupKey(payload):
+    project = payload.get("project") or {}
+    return (project.get("directory"), int(payload.get("start", 0)) // SECONDS_PER_ROLLUP)
+
+# the rollups of the payloads, in the order their first payload came in
+def rollupPayloads(payloads):
+    rollups = OrderedDict()
+    for payload in payloads:
+        key = getRollupKey(payload)
+        rollup = rollups.get(key)
+        if (rollup is None):
+            rollup = dict(payload)
+            rollup["source"] = dict((fileName, dict(fileInfo)) for fileName, fileInfo in (payload.get("source") or {}).items())
+            rollups[key] = rollup
+        else:
+            mergePayload(rollup, payload)
+    return list(rollups.values())
+
+def mergePayload(rollup, payload):
+    rollup["keystrokes"] = rollup.get("keystrokes", 0) + payload.get("keystrokes", 0)
+    if (payload.get("start", 0) < rollup.get("start", 0)):
+        rollup["start"] = payload.get("start", 0)
+        rollup["local_start"] = payload.get("local_start", 0)
+
+    source = rollup["source"]
+    for fileName, fileInfo in (payload.get("source") or {}).items():
+        rollupInfo = source.get(fileName)
+        if (rollupInfo is None):
+            source[fileName] = dict(fileInfo)
+            continue
+
+        for field in SUMMED_FILE_FIELDS:
+            rollupInfo[field] = rollupInfo.get(field, 0) + fileInfo.get(field, 0)
+        if (fileInfo.get("start", 0) < rollupInfo.get("start", 0)):
+            rollupInfo["start"] = fileInfo.get("start", 0)
+            rollupInfo["local_start"] = fileInfo.get("local_start", 0)
+        if (fileInfo.get("end", 0) >= rollupInfo.get("end", 0)):
+            # the file as it was at the end of the hour
+            rollupInfo["end"] = fileInfo.get("end", 0)
+            rollupInfo["local_end"] = fileInfo.get("local_end", 0)
+            rollupInfo["lines"] = fileInfo.get("lines", rollupInfo.get("lines"))
+            rollupInfo["length"] = fileInfo.get("length", rollupInfo.get("length"))
@@ -0,0 +1,132 @@
+# Copyright (c) 2018 by Software.com
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
+import heapq
+import random
+import time
+from .SoftwareSettings import *
+
+# jobs due within this many seconds of each other run in the same wakeup
+ALIGN_WINDOW_SEC = 1
+# threads running the jobs that wait on the network, git or a dialog
+BLOCKING_WORKERS = 2
+
+def schedulerLog(message):
+    if (getValue("software_logging_on", True)):
+        print(message)
+
+#
+# A scheduled call, interval is None for one-shot jobs
+#
+class ScheduledJob():
+    __slots__ = ('func', 'args', 'interval', 'jitter', 'blocking', 'due', 'cancelled')
+
+    def __init__(self, func, args, interval, jitter, blocking=False):
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.blocking = blocking
+        self.due = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+#
+# Single thread running every timed plugin task from a heap
+# of jobs ordered by their monotonic due time. The blocking jobs are
+# handed to a few worker threads, so the short ones like the flushes
+# and write-behinds never wait on an upload.
+#
+class Scheduler():
+    def __init__(self):
+        self.jobs = []
+        self.counter = 0
+        self.condition = Condition()
+        self.running = False
+        self.thread = None
+        self.executor = None
+
+    def schedule(self, job, delay):
+        with self.condition:
+            job.due = time.monotonic() + delay + random.uniform(0, job.jitter)
+            self.counter += 1
+            heapq.heappush(self.jobs, (job.due, self.counter, job))
+            if (self.thread is None):
+                self.running = True
+                self.thread = Thread(target=self.worker, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return job
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for entry in self.jobs:
+                entry[2].cancel()
+            self.jobs = []
+            self.condition.notify()
+            executor = self.executor
+            self.executor = None
+        if (self.thread is not None):
+            self.thread.join(5)
+        if (executor is not None):
+            executor.shutdown(wait=False)
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while (self.running and (not self.jobs or self.jobs[0][0] > time.monotonic())):
+                    if (self.jobs):
+                        self.condition.wait(self.jobs[0][0] - time.monotonic())
+                    else:
+                        self.condition.wait()
+                if (not self.running):
+                    return
+
+                # take every job due in this wakeup
+                dueJobs = []
+                alignedDue = time.monotonic() + ALIGN_WINDOW_SEC
+                while (self.jobs and self.jobs[0][0] <= alignedDue):
+                    dueJobs.append(heapq.heappop(self.jobs)[2])
+
+                if (self.executor is None and any(job.blocking for job in dueJobs)):
+                    self.executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+                executor = self.executor
+
+            for job in dueJobs:
+                if (job.blocking):
+                    # an interval job is scheduled again once it's done,
+                    # so its runs never overlap
+                    executor.submit(self.run, job)
+                else:
+                    self.run(job)
+
+    def run(self, job):
+        if (job.cancelled):
+            return
+        try:
+            job.func(*job.args)
+        except Exception as ex:
+            schedulerLog("Code Time: Scheduled task error: %s" % ex)
+
+        if (job.interval is not None and not job.cancelled and self.running):
+            self.schedule(job, job.interval)
+
+scheduler = Scheduler()
+
+# run func once after delay seconds, on a worker thread when blocking
+def runLater(delay, func, *args, blocking=False):
+    return scheduler.schedule(ScheduledJob(func, args, None, 0, blocking), delay)
+
+# run func every interval seconds, the first run after delay seconds.
+# jitter adds up to that many random seconds to every run. Blocking
+# jobs run on a worker thread.
+def runEvery(interval, func, delay=None, jitter=0, blocking=False):
+    if (delay is None):
+        delay = interval
+    return scheduler.schedule(ScheduledJob(func, (), interval, jitter, blocking), delay)
+
+def stopScheduler():
+    scheduler.stop()
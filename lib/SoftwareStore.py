@@ -0,0 +1,381 @@
+# Copyright (c) 2018 by Software.com
+from threading import Lock
+import json
+import os
+from .SoftwareSettings import *
+from .SoftwareLock import *
+from .SoftwareRollup import *
+from .SoftwareNetwork import *
+
+try:
+    import sqlite3
+except ImportError:
+    # not every Sublime Text 3 build ships the sqlite3 module,
+    # the plugin falls back to the offline journal and json files
+    sqlite3 = None
+
+# payloads read at a time while uploading
+STORE_UPLOAD_READ_ROWS = 200
+SECONDS_PER_DAY = 60 * 60 * 24
+# oldest payloads looked at per eviction step
+EVICT_BATCH_SIZE = 500
+
+STORE_SCHEMA = [
+    # kpm payloads waiting to be uploaded
+    '''CREATE TABLE IF NOT EXISTS payloads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start INTEGER NOT NULL,
+        project TEXT NOT NULL DEFAULT '',
+        keystrokes INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS payloads_start ON payloads (start)',
+    'CREATE INDEX IF NOT EXISTS payloads_project ON payloads (project, start)',
+    # per file totals of every local day, kept after the payloads are uploaded
+    '''CREATE TABLE IF NOT EXISTS file_rollups (
+        day INTEGER NOT NULL,
+        project TEXT NOT NULL DEFAULT '',
+        file TEXT NOT NULL,
+        minutes INTEGER NOT NULL DEFAULT 0,
+        adds INTEGER NOT NULL DEFAULT 0,
+        deletes INTEGER NOT NULL DEFAULT 0,
+        pastes INTEGER NOT NULL DEFAULT 0,
+        lines_added INTEGER NOT NULL DEFAULT 0,
+        lines_removed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, project, file))''',
+    'CREATE INDEX IF NOT EXISTS file_rollups_project ON file_rollups (project, day)',
+    # nothing read the tracks back
+    'DROP TABLE IF EXISTS music_events',
+    # latest commit sent per repo, identifier_branch_tag
+    '''CREATE TABLE IF NOT EXISTS commit_cursors (
+        repo_key TEXT PRIMARY KEY,
+        commit_id TEXT,
+        timestamp INTEGER NOT NULL DEFAULT 0)''',
+    # commits accepted past the cursor while an earlier batch wasn't,
+    # skipped by the next gather
+    '''CREATE TABLE IF NOT EXISTS sent_commits (
+        repo_key TEXT NOT NULL,
+        commit_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (repo_key, commit_id))''',
+    # the session.json keys are only kept in the file
+    'DROP TABLE IF EXISTS session_keys',
+]
+
+def storeLog(message):
+    if (getValue("software_logging_on", True)):
+        print(message)
+
+def getStoreFile():
+    softwareDataDir = os.path.join(os.path.expanduser('~'), '.software')
+    os.makedirs(softwareDataDir, exist_ok=True)
+    return os.path.join(softwareDataDir, 'codetime.db')
+
+#
+# Local metrics kept in ~/.software/codetime.db, an sqlite database in
+# WAL mode so the reads of the dashboard don't wait on the appends.
+# Every method returns a fallback value when sqlite isn't available.
+#
+class MetricsStore():
+    def __init__(self):
+        self.lock = Lock()
+        self.uploadLock = Lock()
+        self.conn = None
+        # None until the first connection attempt
+        self.available = None
+
+    # open the database on first use, None when it can't be used
+    def connect(self):
+        if (self.available is not None):
+            return self.conn
+        self.available = False
+        if (sqlite3 is None):
+            storeLog("Code Time: sqlite3 isn't available, keeping the metrics in files")
+            return None
+        try:
+            conn = sqlite3.connect(getStoreFile(), timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                for statement in STORE_SCHEMA:
+                    conn.execute(statement)
+            self.conn = conn
+            self.available = True
+        except Exception as ex:
+            storeLog("Code Time: Unable to open the metrics store: %s" % ex)
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if (self.conn is not None):
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+            self.conn = None
+            self.available = None
+
+    # run func(conn, *args) in a transaction, returns fallback on failure
+    def write(self, fallback, func, *args):
+        with self.lock:
+            conn = self.connect()
+            if (conn is None):
+                return fallback
+            try:
+                with conn:
+                    return func(conn, *args)
+            except Exception as ex:
+                storeLog("Code Time: Unable to update the metrics store: %s" % ex)
+                return fallback
+
+    def read(self, fallback, sql, params=()):
+        with self.lock:
+            conn = self.connect()
+            if (conn is None):
+                return fallback
+            try:
+                return conn.execute(sql, params).fetchall()
+            except Exception as ex:
+                storeLog("Code Time: Unable to read the metrics store: %s" % ex)
+                return fallback
+
+    #
+    # kpm payloads
+    #
+
+    # store the json payloads and add them to the file rollups,
+    # False if they couldn't be stored
+    def appendPayloads(self, payloads, lines):
+        return self.write(False, self.insertPayloads, payloads, lines)
+
+    # payloads are the dicts, lines their json
+    def insertPayloads(self, conn, payloads, lines):
+        for payloadData, line in zip(payloads, lines):
+            projectDir = self.insertPayload(conn, payloadData, line)
+
+            day = int(payloadData.get("local_start", 0)) // SECONDS_PER_DAY
+            for fileName, fileInfo in (payloadData.get("source") or {}).items():
+                conn.execute('INSERT OR IGNORE INTO file_rollups (day, project, file) VALUES (?, ?, ?)',
+                    (day, projectDir, fileName))
+                conn.execute('''UPDATE file_rollups SET minutes = minutes + 1, adds = adds + ?,
+                    deletes = deletes + ?, pastes = pastes + ?, lines_added = lines_added + ?,
+                    lines_removed = lines_removed + ? WHERE day = ? AND project = ? AND file = ?''',
+                    (fileInfo.get("add", 0), fileInfo.get("delete", 0), fileInfo.get("paste", 0),
+                    fileInfo.get("linesAdded", 0), fileInfo.get("linesRemoved", 0), day, projectDir, fileName))
+        return True
+
+    # the json is stored as utf-8 bytes, ready to be spliced into an upload
+    def insertPayload(self, conn, payloadData, line):
+        project = payloadData.get("project") or {}
+        projectDir = project.get("directory") or ''
+        conn.execute('INSERT INTO payloads (start, project, keystrokes, data) VALUES (?, ?, ?, ?)',
+            (payloadData.get("start", 0), projectDir, payloadData.get("keystrokes", 0), line.encode('utf-8')))
+        return projectDir
+
+    def pendingPayloadCount(self):
+        rows = self.read([(0,)], 'SELECT COUNT(*) FROM payloads')
+        return rows[0][0]
+
+    def pendingBytes(self):
+        rows = self.read([(0,)], 'SELECT COALESCE(SUM(LENGTH(data)), 0) FROM payloads')
+        return rows[0][0]
+
+    def oldestPendingStart(self):
+        rows = self.read([(None,)], 'SELECT MIN(start) FROM payloads')
+        return rows[0][0]
+
+    # the payloads are only uploaded, compacted or evicted by one thread of
+    # one editor instance at a time. Returns the instance lock, None if taken.
+    def lockPayloads(self):
+        if (not self.uploadLock.acquire(False)):
+            return None
+        storeLock = FileLock(getStoreFile())
+        if (not storeLock.acquire(False)):
+            self.uploadLock.release()
+            return None
+        return storeLock
+
+    def unlockPayloads(self, storeLock):
+        storeLock.release()
+        self.uploadLock.release()
+
+    # upload the stored payloads through sendBatch(lines), which gets their
+    # json and returns the batch's outcome. Several batches are in flight
+    # at once, each is deleted as soon as it was accepted, a payload the
+    # server refused on its own is dropped. Stops at the first failure.
+    def upload(self, sendBatch):
+        storeLock = self.lockPayloads()
+        if (storeLock is None):
+            # another upload is already running
+            return False
+        try:
+            failed = []
+            batches = iterBatches(self.iterPendingLines(failed), payloadBatchSize)
+            return uploadBatches(PAYLOADS_API, batches, sendBatch, self.acknowledgeBatch) and not failed
+        finally:
+            self.unlockPayloads(storeLock)
+
+    # the ids of an accepted batch
+    def acknowledgeBatch(self, ids):
+        self.write(None, self.deletePayloadIds, ids)
+
+    # yields (id, payload json or None) for the pending payloads, appends
+    # to failed if they can't be read
+    def iterPendingLines(self, failed):
+        lastId = 0
+        while True:
+            rows = self.read(None, 'SELECT id, data FROM payloads WHERE id > ? ORDER BY id LIMIT ?',
+                (lastId, STORE_UPLOAD_READ_ROWS))
+            if (rows is None):
+                failed.append(lastId)
+                return
+            if (not rows):
+                return
+
+            for rowId, data in rows:
+                line = getPayloadBytes(data)
+                if (not isPayloadLine(line)):
+                    storeLog("Code Time: Skipping an unreadable payload in the metrics store")
+                    line = None
+                yield (rowId, line)
+            lastId = rows[-1][0]
+
+    # roll the pending payloads up into one per project and hour once there
+    # are more than minPayloads, returns the number of payloads merged away
+    def compact(self, minPayloads):
+        if (self.pendingPayloadCount() <= minPayloads):
+            return 0
+        storeLock = self.lockPayloads()
+        if (storeLock is None):
+            # the payloads are being uploaded
+            return 0
+        try:
+            groups = self.read([], '''SELECT project, start / ? AS hour FROM payloads
+                GROUP BY project, hour HAVING COUNT(*) > 1''', (SECONDS_PER_ROLLUP,))
+            merged = 0
+            # a transaction per hour so the appends don't wait on all of it
+            for projectDir, hour in groups:
+                merged += self.write(0, self.compactHour, projectDir, hour)
+            return merged
+        finally:
+            self.unlockPayloads(storeLock)
+
+    def compactHour(self, conn, projectDir, hour):
+        rows = conn.execute('''SELECT id, data FROM payloads WHERE project = ? AND start >= ? AND start < ?
+            ORDER BY id''', (projectDir, hour * SECONDS_PER_ROLLUP, (hour + 1) * SECONDS_PER_ROLLUP)).fetchall()
+        ids = []
+        payloads = []
+        for rowId, data in rows:
+            try:
+                payloads.append(json.loads(getPayloadBytes(data).decode('utf-8')))
+                ids.append(rowId)
+            except Exception:
+                # left for the upload to skip
+                pass
+        if (len(payloads) < 2):
+            return 0
+
+        rollups = rollupPayloads(payloads)
+        for rollup in rollups:
+            self.insertPayload(conn, rollup, json.dumps(rollup))
+        conn.executemany('DELETE FROM payloads WHERE id = ?', [(rowId,) for rowId in ids])
+        return len(payloads) - len(rollups)
+
+    # drop the payloads that started before cutoffStart, then the oldest
+    # until at most maxBytes are left. Returns (payloads, bytes) dropped.
+    def evict(self, maxBytes, cutoffStart):
+        storeLock = self.lockPayloads()
+        if (storeLock is None):
+            return (0, 0)
+        try:
+            dropped = self.write((0, 0), self.evictBefore, cutoffStart)
+            while True:
+                excess = self.pendingBytes() - maxBytes
+                if (excess <= 0):
+                    break
+                rows = self.read([], 'SELECT id, LENGTH(data) FROM payloads ORDER BY id LIMIT ?', (EVICT_BATCH_SIZE,))
+                if (not rows):
+                    break
+                lastId = None
+                count = 0
+                size = 0
+                for rowId, length in rows:
+                    lastId = rowId
+                    count += 1
+                    size += length
+                    if (size >= excess):
+                        break
+                if (not self.write(False, self.deletePayloads, lastId)):
+                    break
+                dropped = (dropped[0] + count, dropped[1] + size)
+            return dropped
+        finally:
+            self.unlockPayloads(storeLock)
+
+    def evictBefore(self, conn, cutoffStart):
+        count, size = conn.execute('''SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM payloads
+            WHERE start < ?''', (cutoffStart,)).fetchone()
+        conn.execute('DELETE FROM payloads WHERE start < ?', (cutoffStart,))
+        return (count, size)
+
+    def deletePayloads(self, conn, lastId):
+        conn.execute('DELETE FROM payloads WHERE id <= ?', (lastId,))
+        return True
+
+    def deletePayloadIds(self, conn, ids):
+        conn.executemany('DELETE FROM payloads WHERE id = ?', [(rowId,) for rowId in ids])
+        return True
+
+    # [(project, file, minutes, keystrokes)] of the local day, most keystrokes first
+    def getTopFiles(self, day, limit):
+        return self.read([], '''SELECT project, file, minutes, adds + deletes AS keystrokes
+            FROM file_rollups WHERE day = ? ORDER BY keystrokes DESC LIMIT ?''', (day, limit))
+
+    # drop the file rollups of the days before cutoffStart's, returns
+    # the number of rows dropped
+    def pruneHistory(self, cutoffStart):
+        return self.write(0, self.deleteHistoryBefore, cutoffStart)
+
+    def deleteHistoryBefore(self, conn, cutoffStart):
+        return conn.execute('DELETE FROM file_rollups WHERE day < ?', (cutoffStart // SECONDS_PER_DAY,)).rowcount
+
+    #
+    # commit cursors
+    #
+
+    # {commitId, timestamp} of the latest commit sent for the repo
+    def getCommitCursor(self, repoKey):
+        rows = self.read([], 'SELECT commit_id, timestamp FROM commit_cursors WHERE repo_key = ?', (repoKey,))
+        if (not rows):
+            return None
+        return {"commitId": rows[0][0], "timestamp": rows[0][1]}
+
+    def setCommitCursor(self, repoKey, commitId, timestamp):
+        return self.write(False, self.replaceCommitCursor, repoKey, commitId, timestamp)
+
+    def replaceCommitCursor(self, conn, repoKey, commitId, timestamp):
+        conn.execute('INSERT OR REPLACE INTO commit_cursors (repo_key, commit_id, timestamp) VALUES (?, ?, ?)',
+            (repoKey, commitId, timestamp))
+        # the next gather starts after these anyway
+        conn.execute('DELETE FROM sent_commits WHERE repo_key = ? AND timestamp < ?', (repoKey, timestamp))
+        return True
+
+    # ids of the commits accepted past the repo's cursor
+    def getSentCommitIds(self, repoKey):
+        rows = self.read([], 'SELECT commit_id FROM sent_commits WHERE repo_key = ?', (repoKey,))
+        return set(row[0] for row in rows)
+
+    def addSentCommits(self, repoKey, commits):
+        return self.write(False, self.insertSentCommits, repoKey, commits)
+
+    def insertSentCommits(self, conn, repoKey, commits):
+        conn.executemany('INSERT OR REPLACE INTO sent_commits (repo_key, commit_id, timestamp) VALUES (?, ?, ?)',
+            [(repoKey, commit['commitId'], commit['timestamp']) for commit in commits])
+        return True
+
+# payloads stored before they were kept as bytes come back as str
+def getPayloadBytes(data):
+    if (isinstance(data, str)):
+        return data.encode('utf-8')
+    return bytes(data)
+
+metricsStore = MetricsStore()
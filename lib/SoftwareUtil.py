@@ -1,5 +1,5 @@
 # Copyright (c) 2018 by Software.com
-from threading import Thread, Timer, Event
+from threading import Thread, Event, Lock
 import os
 import json
 import time
@@ -15,6 +15,10 @@ from urllib.parse import quote_plus
 from subprocess import Popen, PIPE
 from .SoftwareHttp import *
 from .SoftwareSettings import *
+from .SoftwareGit import *
+from .SoftwareScheduler import *
+from .SoftwareStore import *
+from .SoftwareLock import *
 
 # the plugin version
 VERSION = '0.9.4'
@@ -22,10 +26,24 @@ PLUGIN_ID = 1
 DASHBOARD_LABEL_WIDTH = 25
 DASHBOARD_VALUE_WIDTH = 25
 MARKER_WIDTH = 4
+# session.json is written this long after the last setItem
+SESSION_WRITE_DELAY_SEC = 1
+# how often getItem checks whether session.json changed on disk
+SESSION_CHECK_INTERVAL_SEC = 1
+# wait before reading a json file again that was caught half written
+JSON_READ_RETRY_SEC = 0.05
+# how often the cached repo info of a directory is checked against the
+# repo, projects that aren't repos ask for it on every keystroke
+RESOURCE_CHECK_INTERVAL_SEC = 30
 
-sessionMap = {}
 
 runningResourceCmd = False
+# rootDir => (repo signature, resource info)
+resourceInfoCache = {}
+# rootDir => when its cached info was last found up to date
+resourceCheckTimes = {}
+resourceInfoLock = Lock()
+pendingResourceDirs = set()
 loggedInCacheState = False
 timezone=''
 
@@ -61,8 +79,9 @@ def getTimezone():
 #         keystrokeCountObj.timezone = ''
     return timezone
 
-def getLocalStart():
-    now = round(time.time())
+def getLocalStart(now=None):
+    if (now is None):
+        now = round(time.time())
     local_start = now - time.timezone
     try:
         #If current timezone is not in DST, value of tm_ist will be 0
@@ -83,41 +102,116 @@ def getHostname():
 
 # fetch a value from the .software/sesion.json file
 def getItem(key):
-    val = sessionMap.get(key, None)
-    if (val is not None):
-        return val
-    jsonObj = getSoftwareSessionAsJson()
-
-    # return a default of None if key isn't found
-    val = jsonObj.get(key, None)
-
-    return val
+    return sessionCache.get(key)
 
-# get an item from the session json file
+# set an item of the session json file, it's written shortly after
 def setItem(key, value):
-    sessionMap[key] = value
-    jsonObj = getSoftwareSessionAsJson()
-    jsonObj[key] = value
-
-    content = json.dumps(jsonObj)
-
-    sessionFile = getSoftwareSessionFile()
-    with open(sessionFile, 'w') as f:
+    sessionCache.set(key, value)
+
+#
+# Process wide copy of session.json. Changes are written behind with a
+# short delay so a burst of setItem calls writes the file once, and the
+# file is re-read when another editor plugin modified it.
+#
+class SessionCache():
+    def __init__(self):
+        self.lock = Lock()
+        self.items = None
+        # (mtime, size) of session.json when it was last read or written
+        self.fileStat = None
+        self.checkedAt = 0
+        # keys set since the last write
+        self.dirtyKeys = set()
+        self.writeJob = None
+
+    def get(self, key):
+        with self.lock:
+            self.refresh()
+            return self.items.get(key, None)
+
+    def set(self, key, value):
+        with self.lock:
+            self.refresh()
+            self.items[key] = value
+            self.dirtyKeys.add(key)
+            if (self.writeJob is None):
+                self.writeJob = runLater(SESSION_WRITE_DELAY_SEC, self.save)
+
+    # reload the file if it changed on disk, keeping the unsaved keys
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if (self.items is not None and not force and now - self.checkedAt < SESSION_CHECK_INTERVAL_SEC):
+            return
+        self.checkedAt = now
+        sessionFile = getSoftwareSessionFile()
+        fileStat = getFileStat(sessionFile)
+        if (self.items is not None and not force and fileStat == self.fileStat):
+            return
+
+        items = readJsonFile(sessionFile)
+        if (items is None):
+            if (fileStat is not None and self.items is not None):
+                # unreadable, keep what we had rather than losing the jwt
+                return
+            items = {}
+        for key in self.dirtyKeys:
+            items[key] = self.items[key]
+        self.items = items
+        self.fileStat = fileStat
+
+    def save(self):
+        with self.lock:
+            self.writeJob = None
+            if (not self.dirtyKeys):
+                return
+            sessionFile = getSoftwareSessionFile()
+            try:
+                with FileLock(sessionFile):
+                    # don't overwrite what another editor wrote in the meantime
+                    self.refresh(True)
+                    writeFileAtomically(sessionFile, json.dumps(self.items))
+                    self.fileStat = getFileStat(sessionFile)
+            except Exception as ex:
+                log("Code Time: Unable to save the session file: %s" % ex)
+                return
+            self.dirtyKeys = set()
+
+# the parsed json file, None if it's missing or unreadable. A file written
+# in place by another plugin can be caught half written, so a parse
+# error is retried once.
+def readJsonFile(file):
+    for attempt in range(2):
+        try:
+            with open(file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            if (attempt > 0):
+                log("Code Time: Unable to read %s: %s" % (os.path.basename(file), ex))
+                return None
+            time.sleep(JSON_READ_RETRY_SEC)
+
+# write to a temp file first so readers never see a partial file
+def writeFileAtomically(file, content):
+    tmpFile = "%s.%d.tmp" % (file, os.getpid())
+    with open(tmpFile, 'w') as f:
         f.write(content)
+    os.replace(tmpFile, file)
+
+# the mtime and size of the file, None if it doesn't exist
+def getFileStat(file):
+    try:
+        stat = os.stat(file)
+        return (stat.st_mtime, stat.st_size)
+    except Exception:
+        return None
 
 def softwareSessionFileExists():
     file = getSoftwareDir(False)
     sessionFile = os.path.join(file, 'session.json')
     return os.path.isfile(sessionFile)
 
-def getSoftwareSessionAsJson():
-    try:
-        with open(getSoftwareSessionFile()) as sessionFile:
-            loadedSessionFile = json.load(sessionFile)
-            return loadedSessionFile
-    except Exception:
-        return {}
-
 def getSoftwareSessionFile():
     file = getSoftwareDir(True)
     return os.path.join(file, 'session.json')
@@ -282,7 +376,88 @@ def runResourceCmd(cmdArgs, rootDir):
         return ""
 
 
+def getFileMtime(file):
+    try:
+        return os.stat(file).st_mtime
+    except Exception:
+        return None
+
+# the repo state the cached resource info was resolved from
+def getResourceSignature(rootDir):
+    gitDir = getGitDir(rootDir)
+    if (gitDir is None):
+        # a new repo changes the directory mtime
+        return (None, getFileMtime(rootDir))
+    configFile = os.path.join(getCommonGitDir(gitDir), 'config')
+    return (gitDir, getFileMtime(os.path.join(gitDir, 'HEAD')), getFileMtime(configFile))
+
+# get the repo info of the directory, re-using the cached info as long as
+# the repo HEAD and config haven't changed
 def getResourceInfo(rootDir):
+    if (rootDir is None):
+        return {}
+    try:
+        signature = getResourceSignature(rootDir)
+        cached = resourceInfoCache.get(rootDir)
+        if (cached is not None and cached[0] == signature):
+            return cached[1]
+
+        resourceInfo = resolveResourceInfo(rootDir)
+        resourceInfoCache[rootDir] = (signature, resourceInfo)
+        return resourceInfo
+    except Exception as e:
+        return {}
+
+# get the cached repo info without blocking, a missing or
+# outdated entry is resolved on a background thread
+def getCachedResourceInfo(rootDir):
+    if (rootDir is None):
+        return {}
+    cached = resourceInfoCache.get(rootDir)
+    if (cached is not None):
+        now = time.monotonic()
+        if (now - resourceCheckTimes.get(rootDir, 0) < RESOURCE_CHECK_INTERVAL_SEC):
+            return cached[1]
+        if (cached[0] == getResourceSignature(rootDir)):
+            resourceCheckTimes[rootDir] = now
+            return cached[1]
+
+    with resourceInfoLock:
+        if (rootDir in pendingResourceDirs):
+            return None
+        pendingResourceDirs.add(rootDir)
+
+    thread = Thread(target=refreshResourceInfo, args=[rootDir], daemon=True)
+    thread.start()
+    return None
+
+def refreshResourceInfo(rootDir):
+    try:
+        getResourceInfo(rootDir)
+    finally:
+        with resourceInfoLock:
+            pendingResourceDirs.discard(rootDir)
+
+def resolveResourceInfo(rootDir):
+    # read the git files first, git only gets asked
+    # for what they can't answer
+    try:
+        result = readResourceInfo(rootDir)
+        if (result is not None):
+            resourceInfo, askEmail = result
+            if (resourceInfo.get("identifier") is None):
+                return {}
+            if (askEmail):
+                email = runResourceCmd(['git', 'config', 'user.email'], rootDir)
+                if (email):
+                    resourceInfo['email'] = email
+            return resourceInfo
+    except Exception as e:
+        log("Code Time: Unable to read the git repo info: %s" % e)
+
+    return runResourceInfoCmds(rootDir)
+
+def runResourceInfoCmds(rootDir):
     try:
         resourceInfo = {}
         tag = runResourceCmd(['git', 'describe', '--all'], rootDir)
@@ -310,6 +485,11 @@ def getResourceInfo(rootDir):
         return {}
 
 def checkOnline():
+    # the outcome of the recent api requests is as good as a ping
+    health = getApiHealth()
+    if (health is not None):
+        return health
+
     # non-authenticated ping, no need to set the Authorization header
     response = requestIt("GET", "/ping", None, getItem("jwt"))
     if (isResponsOk(response)):
@@ -325,8 +505,7 @@ def refetchUserStatusLazily(tryCountUntilFoundUser):
 
     # start the time
     tryCountUntilFoundUser -= 1
-    t = Timer(10, refetchUserStatusLazily, [tryCountUntilFoundUser])
-    t.start()
+    runLater(10, refetchUserStatusLazily, tryCountUntilFoundUser, blocking=True)
 
 def launchLoginUrl():
     webUrl = getUrlEndpoint()
@@ -384,7 +563,7 @@ def launchCustomDashboard():
     else:
         log("Code Time: could not fetch custom dashboard")
     file = getCustomDashboardFile()
-    sublime.active_window().open_file(file)
+    sublime.set_timeout(lambda: sublime.active_window().open_file(file), 0)
 
 def getAppJwt():
     serverAvailable = checkOnline()
@@ -602,3 +781,4 @@ def getDashboardDataDisplay(widthLen, data):
         content += " "
     return "%s%s" % (content, data)
 
+sessionCache = SessionCache()